@@ -1,13 +1,38 @@
 """
 GuruGPT — Streamlit AI Chatbot with Ollama
-Anonymous multi-session chatbot with PDF analysis and conversation history.
+Anonymous multi-session chatbot with document analysis and conversation history.
 """
 
+import os
+import re
+import asyncio
+import gzip
+import json
 import uuid
+import math
+import queue
+import sqlite3
+import heapq
+import logging
+import unicodedata
 import time
+import hashlib
+import threading
+import html
+import io
+import zipfile
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
+from contextlib import closing
+from itertools import islice
+import numpy as np
 import streamlit as st
 import streamlit.components.v1 as components
-import fitz  # PyMuPDF
+from streamlit.errors import StreamlitAPIException
+
+import pdf_extract
 
 # ─────────────────────────────────────────────────
 # Page config — MUST be first Streamlit call
@@ -20,761 +45,2374 @@ st.set_page_config(
 )
 
 # ─────────────────────────────────────────────────
-# Custom CSS — premium dark theme + resizable sidebar
+# Custom CSS — premium dark theme + resizable sidebar, in static/gurugpt.css
 # ─────────────────────────────────────────────────
-CUSTOM_CSS = """
-<style>
-/* ── Google Font ── */
-@import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&family=Outfit:wght@700;800;900&display=swap');
-
-/* ── Root variables ── */
-:root {
-    --bg-primary: #0d0d14;
-    --bg-secondary: #13131f;
-    --bg-card: #1a1a2e;
-    --bg-sidebar: #0f0f1a;
-    --accent: #7c3aed;
-    --accent-glow: #9d5ffc;
-    --accent-light: #c4b5fd;
-    --text-primary: #f0eeff;
-    --text-secondary: #a89fd0;
-    --border: #2a2a45;
-    --user-bubble: #2d1b69;
-    --assistant-bubble: #141424;
-    --danger: #ef4444;
-    --success: #10b981;
-    --font-main: 'Inter', sans-serif;
-    --font-brand: 'Outfit', sans-serif;
-}
+# Served as app/static/<file> by Streamlit's static file serving (.streamlit/config.toml)
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+THEME_CSS = "gurugpt.css"
+THEME_JS = "gurugpt-toggle.js"
+# Anonymous history id: kept in a browser cookie, never in the URL
+SESSION_COOKIE = "gurugpt_sid"
+SESSION_COOKIE_DAYS = 365
 
-/* ── Global reset ── */
-* { box-sizing: border-box; }
+# ═══════════════════════════════════════════════════════════════════
+# Sidebar toggle — static/gurugpt-toggle.js runs in the main page, once
+#
+# st.markdown never executes <script>, so a zero-height components.html
+# iframe (same origin as the page) is the loader: it injects the controller
+# script into window.parent.document. Reruns may remount the iframe; the
+# loader then finds window.__ggToggle and only asks it to re-sync, so every
+# listener, observer and element exists once per page.
+# ═══════════════════════════════════════════════════════════════════
+TOGGLE_LOADER_HTML = """<script>
+(function () {
+  var P = window.parent, PD = P.document, V = %(version)s, c = P.__ggToggle;
+  if (c && c.version === V) { c.sync(); return; }
+  if (PD.querySelector('script[data-gg-toggle="' + V + '"]')) return;
+  var s = PD.createElement('script');
+  s.setAttribute('data-gg-toggle', V);
+  %(source)s
+  PD.head.appendChild(s);
+})();
+</script>"""
+
+# Streamlit reads cookies (st.context.cookies) but can't set them, so a loader
+# iframe like the one above writes the history cookie on the page's origin
+SESSION_COOKIE_HTML = """<script>
+(function () {
+  var P = window.parent;
+  P.document.cookie = %(cookie)s + (P.location.protocol === 'https:' ? '; Secure' : '');
+})();
+</script>"""
 
-html, body, [class*="css"] {
-    font-family: var(--font-main);
-    background-color: var(--bg-primary);
-    color: var(--text-primary);
-}
 
-/* ── Streamlit main app bg ── */
-.stApp {
-    background: linear-gradient(135deg, #0d0d14 0%, #12101e 50%, #0a0a15 100%);
-    min-height: 100vh;
-}
+# ─────────────────────────────────────────────────
+# Configuration (environment overrides)
+# ─────────────────────────────────────────────────
 
-/* ── Sidebar — always visible, never collapsible ── */
-[data-testid="stSidebar"] {
-    background: var(--bg-sidebar) !important;
-    border-right: 1px solid var(--border);
-    resize: none;
-    overflow: hidden;
-    min-width: 220px !important;
-    max-width: 260px !important;
-    width: 260px !important;
-    transform: none !important;
-    translate: none !important;
-    margin-left: 0 !important;
-    display: flex !important;
-    visibility: visible !important;
-    opacity: 1 !important;
-    pointer-events: auto !important;
-}
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_map(name: str) -> dict[str, str]:
+    """Parse "key=value,key2=value2" (keys may contain ':' like model tags)."""
+    pairs = (item.rsplit("=", 1) for item in os.environ.get(name, "").split(",") if "=" in item)
+    return {k.strip(): v.strip() for k, v in pairs}
+
+
+# Ollama HTTP client: host (None = OLLAMA_HOST / SDK default), timeouts in seconds
+# (read = max silence between streamed chunks) and connection-pool limits
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST") or None
+# Comma-separated pool of Ollama endpoints; defaults to the single OLLAMA_HOST
+OLLAMA_HOSTS = [h.strip() for h in os.environ.get("GURUGPT_OLLAMA_HOSTS", "").split(",") if h.strip()] or [OLLAMA_HOST]
+OLLAMA_CONNECT_TIMEOUT = _env_float("GURUGPT_OLLAMA_CONNECT_TIMEOUT", 5.0)
+OLLAMA_READ_TIMEOUT = _env_float("GURUGPT_OLLAMA_READ_TIMEOUT", 300.0)
+OLLAMA_MAX_CONNECTIONS = int(_env_float("GURUGPT_OLLAMA_MAX_CONNECTIONS", 100))
+OLLAMA_KEEPALIVE_CONNECTIONS = int(_env_float("GURUGPT_OLLAMA_KEEPALIVE_CONNECTIONS", 20))
+# Stream replies through the shared AsyncClient event loop instead of blocking reads
+OLLAMA_ASYNC = os.environ.get("GURUGPT_OLLAMA_ASYNC", "1") not in ("0", "false", "")
+# Seconds between background refreshes of the shared Ollama model catalog
+MODEL_CATALOG_TTL = max(_env_float("GURUGPT_MODEL_TTL", 30.0), 1.0)
+# Streaming: max placeholder redraws per second, and new chars that force a redraw
+STREAM_MAX_FPS = _env_float("GURUGPT_STREAM_FPS", 8.0)
+STREAM_FLUSH_CHARS = int(_env_float("GURUGPT_STREAM_FLUSH_CHARS", 4096))
+# Document retrieval: chunk size, chunks per prompt and total document chars per prompt
+DOC_CHUNK_CHARS = int(_env_float("GURUGPT_DOC_CHUNK_CHARS", 1200))
+DOC_TOP_K = int(_env_float("GURUGPT_DOC_TOP_K", 6))
+DOC_CONTEXT_CHARS = int(_env_float("GURUGPT_DOC_CONTEXT_CHARS", 6000))
+# Semantic retrieval: Ollama embedding model ("" disables it), batch size, documents kept
+EMBED_MODEL = os.environ.get("GURUGPT_EMBED_MODEL", "nomic-embed-text")
+EMBED_BATCH = int(_env_float("GURUGPT_EMBED_BATCH", 32))
+EMBED_CACHE_DOCS = int(_env_float("GURUGPT_EMBED_CACHE_DOCS", 32))
+# PDF extraction: process-pool size and the page count below which it stays serial
+PDF_WORKERS = int(_env_float("GURUGPT_PDF_WORKERS", pdf_extract.default_workers()))
+PDF_PARALLEL_MIN_PAGES = int(_env_float("GURUGPT_PDF_PARALLEL_MIN_PAGES", pdf_extract.PARALLEL_MIN_PAGES))
+# Context budget: cap on the window requested from Ollama (num_ctx), tokens kept
+# free for the reply, and the share of the window an omitted-history summary may use
+CONTEXT_MAX_TOKENS = int(_env_float("GURUGPT_CONTEXT_MAX_TOKENS", 8192))
+CONTEXT_REPLY_TOKENS = int(_env_float("GURUGPT_CONTEXT_REPLY_TOKENS", 1024))
+CONTEXT_SUMMARY_SHARE = _env_float("GURUGPT_CONTEXT_SUMMARY_SHARE", 0.05)
+# Once history overflows, trim it down to this share of the budget in one go, so
+# the kept prefix stays byte-identical (and KV-cache friendly) for several turns
+CONTEXT_REFILL_SHARE = _env_float("GURUGPT_CONTEXT_REFILL_SHARE", 0.6)
+# Ollama keep_alive: default for every model plus per-model overrides ("model=30m,other=-1")
+KEEP_ALIVE = os.environ.get("GURUGPT_KEEP_ALIVE", "")
+KEEP_ALIVE_MODELS = _env_map("GURUGPT_KEEP_ALIVE_MODELS")
+# Concurrent generations admitted per model (default and per-model overrides);
+# extra requests wait in a per-session fair queue
+MAX_PARALLEL = int(_env_float("GURUGPT_MAX_PARALLEL", 4))
+MAX_PARALLEL_MODELS = {k: int(v) for k, v in _env_map("GURUGPT_MAX_PARALLEL_MODELS").items() if v.isdigit()}
+# Background generation threads (only replies granted a scheduler slot take one), and
+# seconds a finished reply stays attachable before only the store has it
+GENERATION_WORKERS = max(int(_env_float("GURUGPT_GENERATION_WORKERS", 32)), 1)
+GENERATION_KEEP = _env_float("GURUGPT_GENERATION_KEEP", 600.0)
+# Fallback when the model's context length can't be read through ollama.show
+DEFAULT_CONTEXT_TOKENS = 4096
+# Response cache (opt-in): entries, lifetime in seconds, and history messages in the key
+RESPONSE_CACHE = os.environ.get("GURUGPT_RESPONSE_CACHE", "0") not in ("0", "false", "")
+RESPONSE_CACHE_SIZE = int(_env_float("GURUGPT_RESPONSE_CACHE_SIZE", 512))
+RESPONSE_CACHE_TTL = _env_float("GURUGPT_RESPONSE_CACHE_TTL", 3600.0)
+RESPONSE_CACHE_TAIL = int(_env_float("GURUGPT_RESPONSE_CACHE_TAIL", 2))
+# Prometheus metrics: local HTTP port (0 = off), bind address, and/or a file rewritten periodically
+METRICS_PORT = int(_env_float("GURUGPT_METRICS_PORT", 0))
+METRICS_ADDR = os.environ.get("GURUGPT_METRICS_ADDR", "127.0.0.1")
+METRICS_FILE = os.environ.get("GURUGPT_METRICS_FILE", "")
+METRICS_FILE_INTERVAL = _env_float("GURUGPT_METRICS_FILE_INTERVAL", 15.0)
+# Conversation history database (SQLite, WAL mode)
+DB_PATH = os.environ.get(
+    "GURUGPT_DB_PATH", os.path.join(os.path.expanduser("~"), ".local", "share", "gurugpt", "gurugpt.db")
+)
+# Extracted-text cache: on-disk directory and size (MB, compressed), in-memory budget (MB of text)
+CACHE_DIR = os.environ.get("GURUGPT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "gurugpt"))
+CACHE_DISK_MB = _env_float("GURUGPT_CACHE_DISK_MB", 2048.0)
+TEXT_CACHE_MB = _env_float("GURUGPT_TEXT_CACHE_MB", 256.0)
+# Largest uncompressed word/document.xml accepted from a .docx (guards against zip bombs)
+DOCX_XML_MB = _env_float("GURUGPT_DOCX_XML_MB", 64.0)
+# Attached documents: MB of indexed text one session keeps in memory (colder ones spill to disk)
+CORPUS_MB = _env_float("GURUGPT_CORPUS_MB", 64.0)
+# Conversations per sidebar page
+HISTORY_PAGE_SIZE = max(int(_env_float("GURUGPT_HISTORY_PAGE_SIZE", 20)), 1)
+# Most recent messages rendered in the chat; "load earlier" adds this many more
+TRANSCRIPT_WINDOW = max(int(_env_float("GURUGPT_TRANSCRIPT_WINDOW", 40)), 2)
+
+logging.basicConfig(level=os.environ.get("GURUGPT_LOG_LEVEL", "WARNING").upper())
+log = logging.getLogger("gurugpt")
 
-/* Target the inner section Streamlit animates to slide the sidebar out */
-[data-testid="stSidebarContent"],
-section[data-testid="stSidebar"] > div {
-    transform: none !important;
-    translate: none !important;
-}
 
-[data-testid="stSidebar"] > div:first-child {
-    padding: 1rem 0.75rem;
-}
+# ─────────────────────────────────────────────────
+# Ollama helpers
+# ─────────────────────────────────────────────────
 
-/* ── Main content area ── */
-[data-testid="stMain"] .block-container {
-    padding-top: 1.5rem;
-    max-width: 860px;
-    margin: 0 auto;
-}
+def _field(obj, name: str, default=None):
+    """Read an attribute from an SDK object or a key from a plain dict (older SDKs)."""
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def _client_kwargs(host: str | None = OLLAMA_HOST) -> dict:
+    import httpx
+    return {
+        "host": host,
+        "timeout": httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+        "limits": httpx.Limits(
+            max_connections=OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=OLLAMA_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=60.0,
+        ),
+    }
 
-/* ── GuruGPT Logo ── */
-.gurugpt-logo {
-    text-align: center;
-    padding: 1.2rem 0 0.6rem;
-    user-select: none;
-}
 
-.gurugpt-logo .icon-wrap {
-    display: inline-flex;
-    align-items: center;
-    justify-content: center;
-    width: 72px;
-    height: 72px;
-    border-radius: 20px;
-    background: linear-gradient(135deg, #7c3aed, #4f46e5);
-    box-shadow: 0 0 32px rgba(124, 58, 237, 0.55), 0 0 8px rgba(124, 58, 237, 0.3);
-    margin: 0 auto 12px;
-    font-size: 2.2rem;
-    animation: logoPulse 3s ease-in-out infinite;
-}
+class OllamaHost:
+    """One Ollama endpoint: its pooled client, last probed models, health and load."""
 
-@keyframes logoPulse {
-    0%, 100% { box-shadow: 0 0 28px rgba(124,58,237,.5), 0 0 6px rgba(124,58,237,.3); }
-    50%       { box-shadow: 0 0 48px rgba(124,58,237,.7), 0 0 16px rgba(124,58,237,.5); }
-}
+    def __init__(self, url: str | None):
+        import ollama
+        self.url = url
+        self.name = url or "127.0.0.1:11434"
+        self.client = ollama.Client(**_client_kwargs(url))
+        self.models: dict[str, dict] = {}
+        self.online = False
+        self.error = ""
+        self.in_flight = 0
+        self.dispatched = 0
 
-.gurugpt-logo h1 {
-    font-family: var(--font-brand);
-    font-size: 2.6rem;
-    font-weight: 900;
-    background: linear-gradient(135deg, #c4b5fd 0%, #7c3aed 50%, #4f46e5 100%);
-    -webkit-background-clip: text;
-    -webkit-text-fill-color: transparent;
-    background-clip: text;
-    margin: 0;
-    letter-spacing: -0.5px;
-    line-height: 1;
-}
 
-.gurugpt-logo p {
-    color: var(--text-secondary);
-    font-size: 0.87rem;
-    font-weight: 400;
-    margin-top: 6px;
-    letter-spacing: 0.4px;
-}
+class AsyncOllamaBridge:
+    """One event-loop thread shared by every streaming reply, with an AsyncClient per host.
 
-/* ── Divider ── */
-.g-divider {
-    border: none;
-    border-top: 1px solid var(--border);
-    margin: 0.8rem 0 1.2rem;
-}
+    HTTP reads for all concurrent generations are multiplexed on the loop; each
+    caller just drains a queue, so no thread sits in a blocking socket read.
+    """
 
-/* ── Sidebar title ── */
-.sidebar-title {
-    font-family: var(--font-brand);
-    font-size: 0.78rem;
-    font-weight: 700;
-    letter-spacing: 1.2px;
-    text-transform: uppercase;
-    color: var(--text-secondary);
-    margin: 0.4rem 0 0.8rem 0.2rem;
-}
+    _DONE = object()
+    POLL = 0.1   # seconds between checks of a stop event
 
-/* ── Conversation item ── */
-.conv-item {
-    display: flex;
-    align-items: center;
-    gap: 6px;
-    padding: 0.55rem 0.7rem;
-    border-radius: 10px;
-    cursor: pointer;
-    margin-bottom: 4px;
-    transition: background 0.15s ease;
-    background: transparent;
-    border: 1px solid transparent;
-}
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="gurugpt-ollama-async", daemon=True).start()
+        self._clients: dict[str | None, object] = {}
+        self._lock = threading.Lock()
 
-.conv-item:hover {
-    background: rgba(124,58,237,0.12);
-    border-color: rgba(124,58,237,0.25);
-}
+    async def _make_client(self, host: str | None):
+        import ollama
+        return ollama.AsyncClient(**_client_kwargs(host))
 
-.conv-item.active {
-    background: rgba(124,58,237,0.2);
-    border-color: rgba(124,58,237,0.45);
-}
+    def client_for(self, host: str | None):
+        """The AsyncClient for `host`, created on the loop the first time it is needed."""
+        with self._lock:
+            if host not in self._clients:
+                future = asyncio.run_coroutine_threadsafe(self._make_client(host), self.loop)
+                self._clients[host] = future.result()
+            return self._clients[host]
 
-.conv-title {
-    flex: 1;
-    font-size: 0.84rem;
-    color: var(--text-primary);
-    white-space: nowrap;
-    overflow: hidden;
-    text-overflow: ellipsis;
-    max-width: 160px;
-}
+    def iterate(self, agen, stop: threading.Event | None = None):
+        """Drive an async generator on the loop, yielding its items to a sync caller.
 
-/* ── Chat messages ── */
-[data-testid="stChatMessage"] {
-    background: transparent !important;
-    margin-bottom: 0.2rem;
-}
+        Closing the returned generator (or abandoning it) cancels the upstream task;
+        so does setting `stop`, within POLL seconds, even while no item arrives.
+        """
+        items: queue.Queue = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put_nowait(item)
+            finally:
+                items.put_nowait(self._DONE)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                try:
+                    item = items.get(timeout=self.POLL if stop is not None else None)
+                except queue.Empty:
+                    if stop.is_set():
+                        return
+                    continue
+                if item is self._DONE:
+                    break
+                yield item
+            future.result()
+        finally:
+            future.cancel()
+
+
+@st.cache_resource(show_spinner=False)
+def _async_ollama() -> AsyncOllamaBridge:
+    return AsyncOllamaBridge()
+
+
+def fetch_ollama_catalog(client) -> dict[str, dict]:
+    """Query Ollama for installed models. Returns {name: metadata}; raises if unreachable."""
+    result = client.list()
+    catalog = {}
+    for m in _field(result, "models", None) or []:
+        name = _field(m, "model") or _field(m, "name")
+        if not name:
+            continue
+        details = _field(m, "details") or {}
+        catalog[name] = {
+            "size": _field(m, "size") or 0,
+            "family": _field(details, "family") or "",
+            "parameter_size": _field(details, "parameter_size") or "",
+            "quantization": _field(details, "quantization_level") or "",
+        }
+    return catalog
+
+
+def _model_key(name: str) -> str:
+    """Ollama treats `llama3` and `llama3:latest` as the same model."""
+    return name if ":" in name.rsplit("/", 1)[-1] else f"{name}:latest"
+
+
+class OllamaPool:
+    """Every configured Ollama host, probed by a background thread.
+
+    A probe lists the host's models, which doubles as its health check. The
+    merged catalog feeds the model picker; requests go to the healthy host with
+    the model and the fewest generations in flight. Readers never touch the network.
+    """
+
+    def __init__(self, hosts: list[OllamaHost], ttl: float, fetch=fetch_ollama_catalog):
+        self.hosts = hosts
+        self.ttl = ttl
+        self._fetch = fetch
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.updated_at = 0.0
+        # First snapshot is taken synchronously so the very first page isn't empty
+        self.refresh()
+        threading.Thread(target=self._loop, name="gurugpt-ollama-probe", daemon=True).start()
+
+    def _probe(self, host: OllamaHost, results: dict):
+        try:
+            results[host] = (self._fetch(host.client), "")
+        except Exception as e:
+            results[host] = (None, str(e))
+
+    def refresh(self):
+        """Probe all hosts concurrently, so a dead one costs one connect timeout, not one per host."""
+        results: dict[OllamaHost, tuple] = {}
+        probes = [threading.Thread(target=self._probe, args=(h, results), daemon=True) for h in self.hosts]
+        for t in probes:
+            t.start()
+        for t in probes:
+            t.join()
+        with self._lock:
+            for host, (models, error) in results.items():
+                if host.online and models is None:
+                    log.warning("ollama host %s is down: %s", host.name, error)
+                host.online = models is not None
+                host.models = models or {}
+                host.error = error
+            self.updated_at = time.time()
+
+    def _loop(self):
+        while not self._stop.wait(self.ttl):
+            self.refresh()
+
+    def close(self):
+        self._stop.set()
+
+    def names(self) -> list[str]:
+        """Model names across all healthy hosts; a placeholder if they are up but empty, [] if all are offline."""
+        with self._lock:
+            online = [h for h in self.hosts if h.online]
+            if not online:
+                return []
+            return list(dict.fromkeys(name for h in online for name in h.models)) or ["(nenhum modelo encontrado)"]
+
+    def _has(self, host: OllamaHost, model: str) -> bool:
+        key = _model_key(model)
+        return any(_model_key(name) == key for name in host.models)
+
+    def info(self, name: str | None) -> dict:
+        """Metadata of `name` from the first host that has it, plus how many healthy hosts do."""
+        if not name:
+            return {}
+        with self._lock:
+            hosts = [h for h in self.hosts if h.online and self._has(h, name)]
+            if not hosts:
+                return {}
+            key = _model_key(name)
+            meta = next(m for n, m in hosts[0].models.items() if _model_key(n) == key)
+            return {**meta, "hosts": len(hosts)}
+
+    def acquire(self, model: str, exclude=()) -> OllamaHost | None:
+        """Reserve the least-loaded healthy host that has `model` (None if there is none)."""
+        with self._lock:
+            candidates = [h for h in self.hosts if h.online and h not in exclude and self._has(h, model)]
+            if not candidates:
+                return None
+            host = min(candidates, key=lambda h: (h.in_flight, h.dispatched))
+            host.in_flight += 1
+            host.dispatched += 1
+            return host
+
+    def release(self, host: OllamaHost):
+        with self._lock:
+            host.in_flight -= 1
+
+    def failed(self, host: OllamaHost, error: Exception):
+        """A request to `host` failed. Transport errors take it out of rotation until the next good probe;
+        an error response from a live server (model missing, out of memory...) does not."""
+        import ollama
+        if isinstance(error, ollama.ResponseError):
+            return
+        with self._lock:
+            host.online = False
+            host.error = str(error)
+        log.warning("ollama host %s marked down: %s", host.name, error)
+
+    def snapshot(self) -> dict[str, dict]:
+        with self._lock:
+            return {
+                h.name: {"online": h.online, "in_flight": h.in_flight, "models": len(h.models)}
+                for h in self.hosts
+            }
 
-[data-testid="stChatMessage"][data-testid*="user"] .stChatMessageContent {
-    background: var(--user-bubble) !important;
-    border-radius: 18px 18px 4px 18px !important;
-    border: 1px solid rgba(124,58,237,0.3);
-}
 
-[data-testid="stChatMessage"][data-testid*="assistant"] .stChatMessageContent {
-    background: var(--assistant-bubble) !important;
-    border-radius: 18px 18px 18px 4px !important;
-    border: 1px solid var(--border);
-}
+@st.cache_resource(show_spinner=False)
+def _ollama_pool() -> OllamaPool:
+    return OllamaPool([OllamaHost(url) for url in OLLAMA_HOSTS], MODEL_CATALOG_TTL)
 
-/* ── Selectbox ── */
-.stSelectbox > div > div {
-    background: var(--bg-card) !important;
-    border: 1px solid var(--border) !important;
-    border-radius: 10px !important;
-    color: var(--text-primary) !important;
-}
 
-.stSelectbox > div > div:focus-within {
-    border-color: var(--accent) !important;
-    box-shadow: 0 0 0 2px rgba(124,58,237,0.25) !important;
-}
+def get_ollama_models() -> list[str]:
+    """Return the Ollama model names installed on any healthy host (merged catalog, no network I/O)."""
+    return _ollama_pool().names()
+
+
+def call_ollama(model: str, fn):
+    """Run fn(client) against a host that has `model`, moving to the next host if it fails."""
+    pool = _ollama_pool()
+    tried, error = [], None
+    while (host := pool.acquire(model, tried)) is not None:
+        tried.append(host)
+        try:
+            return fn(host.client)
+        except Exception as e:
+            pool.failed(host, e)
+            error = e
+            log.warning("ollama host %s failed: %s", host.name, e)
+        finally:
+            pool.release(host)
+    raise error or ConnectionError(f"nenhum servidor Ollama disponível com o modelo {model}")
+
+
+def _human_size(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def keep_alive_for(model: str) -> str | int | float | None:
+    """keep_alive sent with requests for `model` (None leaves the server default).
+
+    Overrides match like Ollama names do (`llama3` is `llama3:latest`). Bare
+    numbers go out as numbers (seconds, negative = keep loaded): Ollama parses
+    strings as Go durations, which reject "-1" for lacking a unit.
+    """
+    key = _model_key(model)
+    value = next((v for k, v in KEEP_ALIVE_MODELS.items() if _model_key(k) == key), KEEP_ALIVE).strip()
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return int(number) if number.is_integer() else number
+
+
+def stream_ollama_response(model: str, messages: list[dict], options: dict | None = None,
+                           stats: dict | None = None, stop: threading.Event | None = None):
+    """Generator that yields text chunks from Ollama streaming chat.
+
+    The request goes to the least-busy healthy host that has `model`; if that
+    host fails before the first token, the next one is tried. If `stats` is
+    given, it is filled with the counters of the final chunk
+    (prompt_eval_count, eval_count, durations...). Setting `stop` (or closing
+    the generator) closes the HTTP stream, which makes Ollama abort the
+    generation; the generator then just ends.
+    """
+    pool = _ollama_pool()
+    tried, error = [], None
+    while (host := pool.acquire(model, tried)) is not None:
+        tried.append(host)
+        started = False
+        try:
+            for delta in _host_chat_stream(host, model, messages, options, stats, stop):
+                started = True
+                yield delta
+            return
+        except Exception as e:
+            if started:
+                yield f"\n\n⚠️ Erro ao comunicar com Ollama: {e}"
+                return
+            pool.failed(host, e)
+            error = e
+            log.warning("ollama host %s failed before the first token: %s", host.name, e)
+        finally:
+            pool.release(host)
+        if stop is not None and stop.is_set():
+            return
+    yield f"\n\n⚠️ Erro ao comunicar com Ollama: {error or f'nenhum servidor disponível com o modelo {model}'}"
+
+
+def _host_chat_stream(host: OllamaHost, model: str, messages: list[dict],
+                      options: dict | None, stats: dict | None, stop: threading.Event | None = None):
+    """Stream one chat from one host; raises on failure.
+
+    With the async bridge, `stop` closes the stream at once; the blocking client
+    only notices it between chunks.
+    """
+    if OLLAMA_ASYNC:
+        bridge = _async_ollama()
+        yield from bridge.iterate(
+            astream_ollama_response(bridge.client_for(host.url), model, messages, options, stats), stop
+        )
+        return
+    stream = host.client.chat(
+        model=model, messages=messages, stream=True, options=options,
+        keep_alive=keep_alive_for(model),
+    )
+    for chunk in stream:
+        if stop is not None and stop.is_set():
+            stream.close()
+            return
+        delta = chunk.message.content if hasattr(chunk, "message") else ""
+        if delta:
+            yield delta
+        if stats is not None and _field(chunk, "done"):
+            stats.update({k: _field(chunk, k) for k in _FINAL_CHUNK_FIELDS})
+
+
+async def astream_ollama_response(client, model: str, messages: list[dict],
+                                  options: dict | None = None, stats: dict | None = None):
+    """Async chat stream for an ollama.AsyncClient; raises on failure."""
+    stream = await client.chat(
+        model=model, messages=messages, stream=True, options=options,
+        keep_alive=keep_alive_for(model),
+    )
+    async for chunk in stream:
+        delta = chunk.message.content if hasattr(chunk, "message") else ""
+        if delta:
+            yield delta
+        if stats is not None and _field(chunk, "done"):
+            stats.update({k: _field(chunk, k) for k in _FINAL_CHUNK_FIELDS})
 
-/* ── File uploader ── */
-[data-testid="stFileUploader"] {
-    background: var(--bg-card);
-    border: 1.5px dashed var(--border);
-    border-radius: 12px;
-    padding: 0.8rem;
-    transition: border-color 0.2s;
-}
 
-[data-testid="stFileUploader"]:hover {
-    border-color: var(--accent);
-}
+_FINAL_CHUNK_FIELDS = (
+    "total_duration", "load_duration", "prompt_eval_count",
+    "prompt_eval_duration", "eval_count", "eval_duration",
+)
 
-/* ── Chat input ── */
-[data-testid="stChatInput"] {
-    background: var(--bg-card) !important;
-    border: 1px solid var(--border) !important;
-    border-radius: 14px !important;
-    box-shadow: 0 0 20px rgba(124,58,237,0.08);
-}
 
-[data-testid="stChatInput"]:focus-within {
-    border-color: var(--accent) !important;
-    box-shadow: 0 0 0 2px rgba(124,58,237,0.2), 0 0 20px rgba(124,58,237,0.12) !important;
-}
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_context_length(model: str) -> int:
+    """Context length advertised by the model (raises if Ollama can't tell; not cached then)."""
+    info = _field(call_ollama(model, lambda client: client.show(model)), "modelinfo") or {}
+    for key, value in info.items():
+        if key.endswith(".context_length"):
+            return int(value)
+    raise LookupError(f"no context_length for {model}")
 
-/* ── Buttons ── */
-.stButton > button {
-    background: linear-gradient(135deg, #7c3aed, #4f46e5);
-    color: white !important;
-    border: none;
-    border-radius: 10px;
-    font-weight: 600;
-    font-family: var(--font-main);
-    transition: all 0.2s ease;
-    box-shadow: 0 2px 12px rgba(124,58,237,0.3);
-}
 
-.stButton > button:hover {
-    transform: translateY(-1px);
-    box-shadow: 0 4px 20px rgba(124,58,237,0.45);
-}
+def model_context_length(model: str) -> int:
+    try:
+        return _fetch_context_length(model)
+    except Exception as e:
+        log.info("context length of %s unknown, assuming %d: %s", model, DEFAULT_CONTEXT_TOKENS, e)
+        return DEFAULT_CONTEXT_TOKENS
 
-.stButton > button:active {
-    transform: translateY(0);
-}
 
-/* ── Danger/delete button ── */
-.delete-btn > button {
-    background: transparent !important;
-    color: var(--danger) !important;
-    border: 1px solid rgba(239,68,68,0.3) !important;
-    box-shadow: none !important;
-    padding: 0.2rem 0.6rem !important;
-    font-size: 0.75rem !important;
-    border-radius: 8px !important;
-}
+def _embed(client, texts: list[str], model: str) -> list[list[float]]:
+    if hasattr(client, "embed"):
+        return list(_field(client.embed(model=model, input=texts), "embeddings"))
+    # Older SDKs only expose the single-prompt endpoint
+    return [_field(client.embeddings(model=model, prompt=t), "embedding") for t in texts]
 
-.delete-btn > button:hover {
-    background: rgba(239,68,68,0.15) !important;
-    border-color: var(--danger) !important;
-    transform: none !important;
-    box-shadow: none !important;
-}
 
-/* ── PDF badge ── */
-.pdf-badge {
-    display: inline-flex;
-    align-items: center;
-    gap: 6px;
-    background: rgba(124,58,237,0.15);
-    border: 1px solid rgba(124,58,237,0.35);
-    border-radius: 8px;
-    padding: 4px 10px;
-    font-size: 0.78rem;
-    color: var(--accent-light);
-    margin-bottom: 0.6rem;
-}
+def ollama_embed(texts: list[str], model: str = EMBED_MODEL) -> list[list[float]]:
+    """Embed a batch of texts through the Ollama embeddings endpoint of a host that has `model`."""
+    return call_ollama(model, lambda client: _embed(client, texts, model))
 
-/* ── Status bar ── */
-.status-bar {
-    display: flex;
-    align-items: center;
-    gap: 8px;
-    font-size: 0.78rem;
-    color: var(--text-secondary);
-    margin-bottom: 1rem;
-}
 
-.status-dot {
-    width: 8px;
-    height: 8px;
-    border-radius: 50%;
-    background: var(--success);
-    box-shadow: 0 0 6px var(--success);
-    animation: blink 2s ease-in-out infinite;
-}
+# ─────────────────────────────────────────────────
+# Generation scheduler
+# ─────────────────────────────────────────────────
 
-.status-dot.offline {
-    background: var(--danger);
-    box-shadow: 0 0 6px var(--danger);
-    animation: none;
-}
+class _Ticket:
+    __slots__ = ("model", "anon_id", "granted", "on_grant")
+
+    def __init__(self, model: str, anon_id: str, on_grant):
+        self.model, self.anon_id, self.granted = model, anon_id, False
+        self.on_grant = on_grant
+
+
+class GenerationScheduler:
+    """Process-wide admission control in front of Ollama.
+
+    At most `limit_for(model)` generations run per model; the rest wait in
+    per-session queues served round-robin, so one session firing many prompts
+    can't starve the others. enqueue() holds a place in line without blocking
+    and calls back once the slot is granted.
+    """
+
+    def __init__(self, default_limit: int = MAX_PARALLEL, limits: dict[str, int] | None = None):
+        self.default_limit = max(1, default_limit)
+        # Keyed like Ollama names match (`llama3` is `llama3:latest`)
+        self.limits = {_model_key(k): v for k, v in (limits or {}).items()}
+        self._lock = threading.Lock()
+        self._running: dict[str, int] = {}
+        # model -> OrderedDict(anon_id -> deque of tickets); order is the round-robin ring
+        self._waiting: dict[str, OrderedDict[str, deque]] = {}
+
+    def limit_for(self, model: str) -> int:
+        return max(1, self.limits.get(_model_key(model), self.default_limit))
+
+    def _dispatch(self, model: str) -> list[_Ticket]:
+        """Grant free slots; returns the granted tickets, whose callbacks are still to run."""
+        ring = self._waiting.get(model)
+        granted = []
+        while ring and self._running.get(model, 0) < self.limit_for(model):
+            anon_id, tickets = next(iter(ring.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                ring.move_to_end(anon_id)  # next turn goes to another session
+            else:
+                del ring[anon_id]
+            ticket.granted = True
+            self._running[model] = self._running.get(model, 0) + 1
+            granted.append(ticket)
+        return granted
+
+    @staticmethod
+    def _notify(granted: list[_Ticket]):
+        # Outside the lock: a callback may take a while or call back in
+        for ticket in granted:
+            ticket.on_grant(ticket)
+
+    def _position(self, ticket: _Ticket) -> int:
+        """1-based place in line. Grants go in rounds: the k-th ticket of every
+        session is served, in ring order, before anyone's (k+1)-th."""
+        k = self._waiting[ticket.model][ticket.anon_id].index(ticket)
+        ahead, before_us = 0, True
+        for anon_id, tickets in self._waiting[ticket.model].items():
+            before_us = before_us and anon_id != ticket.anon_id
+            ahead += min(len(tickets), k) + (before_us and len(tickets) > k)
+        return ahead + 1
+
+    def position(self, ticket: _Ticket) -> int:
+        """`ticket`'s place in line, 0 once granted or withdrawn."""
+        with self._lock:
+            if ticket.granted or ticket not in self._waiting.get(ticket.model, {}).get(ticket.anon_id, ()):
+                return 0
+            return self._position(ticket)
+
+    def _leave(self, ticket: _Ticket) -> bool:
+        """Take `ticket` out of line; False if it is no longer waiting."""
+        ring = self._waiting.get(ticket.model, {})
+        tickets = ring.get(ticket.anon_id)
+        if not tickets or ticket not in tickets:
+            return False
+        tickets.remove(ticket)
+        if not tickets:
+            del ring[ticket.anon_id]
+        return True
+
+    def enqueue(self, model: str, anon_id: str, on_grant) -> _Ticket:
+        """Queue for a slot without blocking; on_grant(ticket) runs once it is granted
+        (right away, or in the thread whose release() frees the slot)."""
+        ticket = _Ticket(model, anon_id, on_grant)
+        with self._lock:
+            self._waiting.setdefault(model, OrderedDict()).setdefault(anon_id, deque()).append(ticket)
+            granted = self._dispatch(model)
+        self._notify(granted)
+        return ticket
+
+    def withdraw(self, ticket: _Ticket) -> bool:
+        """Leave the line; False if the slot was already granted (release it instead)
+        or the ticket was withdrawn before."""
+        with self._lock:
+            return not ticket.granted and self._leave(ticket)
+
+    def _release(self, model: str) -> list[_Ticket]:
+        self._running[model] -= 1
+        return self._dispatch(model)
+
+    def release(self, ticket: _Ticket):
+        with self._lock:
+            granted = self._release(ticket.model)
+        self._notify(granted)
+
+    def snapshot(self) -> dict[str, dict]:
+        with self._lock:
+            return {
+                model: {"running": self._running.get(model, 0),
+                        "waiting": sum(map(len, self._waiting.get(model, {}).values()))}
+                for model in set(self._running) | set(self._waiting)
+            }
 
-@keyframes blink {
-    0%, 100% { opacity: 1; }
-    50%       { opacity: 0.4; }
-}
 
-/* ── Wrappers for model selector row ── */
-.model-row {
-    background: var(--bg-card);
-    border: 1px solid var(--border);
-    border-radius: 14px;
-    padding: 0.9rem 1.1rem 0.7rem;
-    margin-bottom: 1.1rem;
-}
+@st.cache_resource(show_spinner=False)
+def _scheduler() -> GenerationScheduler:
+    return GenerationScheduler(MAX_PARALLEL, MAX_PARALLEL_MODELS)
 
-/* ── Scrollbar ── */
-::-webkit-scrollbar { width: 5px; height: 5px; }
-::-webkit-scrollbar-track { background: transparent; }
-::-webkit-scrollbar-thumb { background: #2a2a45; border-radius: 99px; }
-::-webkit-scrollbar-thumb:hover { background: var(--accent); }
 
-/* ── Error / warning alerts ── */
-.stAlert {
-    border-radius: 10px !important;
-}
+# ─────────────────────────────────────────────────
+# Document helpers (PDF, TXT, Markdown, DOCX)
+# ─────────────────────────────────────────────────
 
-/* ── Spinner ── */
-.stSpinner > div {
-    border-top-color: var(--accent) !important;
-}
+# Upload extension → extractor kind
+DOCUMENT_KINDS = {"pdf": "pdf", "txt": "text", "md": "text", "markdown": "text", "docx": "docx"}
+# Unpaginated formats are cut into pseudo-pages of about a printed page
+TEXT_PAGE_CHARS = 3000
+_DOCX_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def document_kind(filename: str) -> str | None:
+    return DOCUMENT_KINDS.get(os.path.splitext(filename)[1].lstrip(".").lower())
+
+
+def _decode_text(file_bytes: bytes) -> str:
+    """Plain-text upload as str: UTF-8 (with or without BOM), else Windows-1252/Latin-1."""
+    for encoding in ("utf-8-sig", "cp1252"):
+        try:
+            return file_bytes.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return file_bytes.decode("latin-1")
+
+
+def _docx_text(file_bytes: bytes) -> str:
+    """Paragraph text of a .docx (body and tables), read straight from its XML."""
+    cap = int(DOCX_XML_MB * 1024 * 1024)
+    with zipfile.ZipFile(io.BytesIO(file_bytes)) as zf:
+        # The declared size comes from the archive and can lie, so the read is bounded too
+        if zf.getinfo("word/document.xml").file_size > cap:
+            raise ValueError(f"documento descompactado maior que {DOCX_XML_MB:g} MB")
+        with zf.open("word/document.xml") as member:
+            xml = member.read(cap + 1)
+        if len(xml) > cap:
+            raise ValueError(f"documento descompactado maior que {DOCX_XML_MB:g} MB")
+        root = ElementTree.fromstring(xml)
+    paragraphs = []
+    for para in root.iter(f"{_DOCX_NS}p"):
+        parts = []
+        for node in para.iter():
+            if node.tag == f"{_DOCX_NS}t":
+                parts.append(node.text or "")
+            elif node.tag == f"{_DOCX_NS}tab":
+                parts.append("\t")
+            elif node.tag in (f"{_DOCX_NS}br", f"{_DOCX_NS}cr"):
+                parts.append("\n")
+        paragraphs.append("".join(parts))
+    return "\n\n".join(paragraphs)
+
+
+def text_pages(text: str, size: int = TEXT_PAGE_CHARS) -> list[str]:
+    """Pack paragraphs into pseudo-pages of about `size` chars (a paragraph is never split)."""
+    pages, buf = [], []
+    used = 0
+    for para in re.split(r"\n\s*\n", text):
+        if not para.strip():
+            continue
+        if buf and used + len(para) > size:
+            pages.append("\n\n".join(buf))
+            buf, used = [], 0
+        buf.append(para)
+        used += len(para) + 2
+    if buf:
+        pages.append("\n\n".join(buf))
+    return pages
+
+
+def iter_document_pages(file_bytes: bytes, kind: str):
+    """Yield (page number, page count, text) for a document of any supported kind."""
+    if kind == "pdf":
+        yield from pdf_extract.iter_pages(file_bytes, PDF_WORKERS, PDF_PARALLEL_MIN_PAGES)
+        return
+    text = _docx_text(file_bytes) if kind == "docx" else _decode_text(file_bytes)
+    pages = text_pages(text)
+    for page_no, page in enumerate(pages, start=1):
+        yield page_no, len(pages), page
+
+
+class DocumentTextCache:
+    """Content-addressed cache of extracted document pages, keyed by SHA-256 of the file.
+
+    Every document is streamed to `directory` (gzipped JSON lines: a {"pages": n}
+    header, then one page per line) as it is extracted, so it survives evictions
+    and restarts; the store is kept under `max_disk_bytes` by deleting the entries
+    read least recently (file mtime). Hot documents also stay in an in-memory LRU
+    bounded by `max_chars`. Disk errors degrade to memory-only.
+    """
+
+    def __init__(self, directory: str, max_chars: int, max_disk_bytes: int):
+        self.directory = directory
+        self.max_chars = max_chars
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._items: OrderedDict[str, list[str]] = OrderedDict()
+        self._chars = 0
+        # key -> [extraction lock, sessions holding or waiting for it]
+        self._building: dict[str, list] = {}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, "text", f"{key}.jsonl.gz")
+
+    def has(self, key: str) -> bool:
+        """Whether the pages for `key` can be read back without the original file."""
+        with self._lock:
+            if key in self._items:
+                return True
+        return os.path.exists(self._path(key))
+
+    def _remember(self, key: str, pages: list[str]):
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = pages
+                self._chars += sum(map(len, pages))
+            self._items.move_to_end(key)
+            while self._chars > self.max_chars and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self._chars -= sum(map(len, old))
+
+    def _cached(self, key: str) -> list[str] | None:
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        return None
+
+    def _iter_disk(self, key: str):
+        """Stream (page number, page count, text) from the disk store; raises if absent."""
+        with gzip.open(self._path(key), "rt", encoding="utf-8") as f:
+            n_pages, page_no = 0, 0
+            for line in f:
+                item = json.loads(line)
+                if isinstance(item, dict):
+                    n_pages = item.get("pages", 0)
+                    continue
+                page_no += 1
+                yield page_no, n_pages, item
+
+    def _read_disk(self, key: str, file_bytes: bytes | None):
+        """Yield the stored pages; returns False, having yielded nothing, if they must be extracted."""
+        yielded = 0
+        try:
+            for item in self._iter_disk(key):
+                yielded += 1
+                yield item
+        except FileNotFoundError:
+            if file_bytes is None:
+                raise
+            return False
+        except (OSError, ValueError) as e:
+            if yielded or file_bytes is None:
+                raise
+            log.warning("unreadable text cache entry %s, re-extracting: %s", key, e)
+            self._discard(key)
+            return False
+        # Reading refreshes the entry's place in the disk LRU
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return True
+
+    def _discard(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _trim_disk(self, keep: str):
+        """Delete the least recently read entries until the store fits `max_disk_bytes`."""
+        keep_path = self._path(keep)
+        entries = []
+        try:
+            with os.scandir(os.path.dirname(keep_path)) as it:
+                for entry in it:
+                    if entry.name.endswith(".jsonl.gz"):
+                        info = entry.stat()
+                        entries.append((info.st_mtime, info.st_size, entry.path))
+        except OSError as e:
+            log.warning("could not size the text cache: %s", e)
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            if path == keep_path:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.warning("could not evict text cache entry %s: %s", path, e)
+                continue
+            total -= size
+
+    def _write_through(self, key: str, pages):
+        """Pass (page number, page count, text) items through, appending each to the store.
+
+        The entry only becomes visible (atomic rename) once every page was written;
+        if the store is unwritable the pages still flow, only persistence is lost.
+        """
+        path = self._path(key)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        f, n_pages = None, 0
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = gzip.open(tmp, "wt", encoding="utf-8", compresslevel=1)
+        except OSError as e:
+            log.warning("could not persist text cache entry %s: %s", key, e)
+        try:
+            for page_no, n_pages, text in pages:
+                if f is not None:
+                    if page_no == 1:
+                        f.write(json.dumps({"pages": n_pages}) + "\n")
+                    f.write(json.dumps(text, ensure_ascii=False) + "\n")
+                yield page_no, n_pages, text
+            if f is not None:
+                if not n_pages:
+                    f.write(json.dumps({"pages": 0}) + "\n")
+                f.close()
+                os.replace(tmp, path)
+                self._trim_disk(key)
+        finally:
+            if f is not None and not f.closed:
+                f.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def iter_pages(self, file_bytes: bytes | None, key: str | None = None, kind: str = "pdf"):
+        """Yield (page number, page count, text) from the cache or straight from extraction.
+
+        A miss is extracted page by page and written through to disk; the in-memory
+        tier keeps the document only if it fits the cache budget, so peak memory
+        of an ingestion follows the page, not the document. Without `file_bytes`
+        only cached documents can be read (a miss raises FileNotFoundError).
+        """
+        key = key or hashlib.sha256(file_bytes).hexdigest()
+        pages = self._cached(key)
+        if pages is None:
+            if (yield from self._read_disk(key, file_bytes)):
+                return
+            with self._lock:
+                building = self._building.setdefault(key, [threading.Lock(), 0])
+                building[1] += 1
+            try:
+                # Concurrent uploads of the same file wait for one extraction, then
+                # read its result once the lock is released
+                with building[0]:
+                    pages = self._cached(key)
+                    if pages is None and not os.path.exists(self._path(key)):
+                        yield from self._extract(key, file_bytes, kind)
+                        return
+            finally:
+                with self._lock:
+                    building[1] -= 1
+                    if not building[1]:
+                        self._building.pop(key, None)
+            if pages is None:
+                yield from self._iter_disk(key)
+                return
+        for i, text in enumerate(pages, start=1):
+            yield i, len(pages), text
+
+    def _extract(self, key: str, file_bytes: bytes, kind: str):
+        keep, kept_chars = [], 0
+        for item in self._write_through(key, iter_document_pages(file_bytes, kind)):
+            if keep is not None:
+                kept_chars += len(item[2])
+                if kept_chars > self.max_chars:
+                    keep = None
+                else:
+                    keep.append(item[2])
+            yield item
+        if keep is not None:
+            self._remember(key, keep)
+
+
+@st.cache_resource(show_spinner=False)
+def _text_cache() -> DocumentTextCache:
+    return DocumentTextCache(CACHE_DIR, int(TEXT_CACHE_MB * 1024 * 1024), int(CACHE_DISK_MB * 1024 * 1024))
+
+
+def chunk_page(page_no: int, page: str, size: int = DOC_CHUNK_CHARS) -> list[dict]:
+    """Split one page's text into ~`size`-char chunks.
+
+    Paragraphs are packed together; an overfull chunk is cut at the last
+    paragraph break, or failing that the last space, before the limit.
+    """
+    chunks, buf = [], ""
+    for para in re.split(r"\n\s*\n", page):
+        para = " ".join(para.split())
+        if not para:
+            continue
+        buf = f"{buf}\n{para}" if buf else para
+        while len(buf) > size:
+            cut = buf.rfind("\n", 0, size)
+            if cut < size // 2:
+                cut = buf.rfind(" ", 0, size)
+            if cut < size // 2:
+                cut = size
+            chunks.append({"page": page_no, "text": buf[:cut].rstrip()})
+            buf = buf[cut:].lstrip()
+    if buf:
+        chunks.append({"page": page_no, "text": buf})
+    return chunks
 
-/* ── Hide Streamlit default header / footer ── */
-#MainMenu { visibility: hidden; }
-footer { visibility: hidden; }
-header { visibility: hidden; }
 
-/* ── Sidebar new chat button full width ── */
-[data-testid="stSidebar"] .stButton > button {
-    width: 100%;
-    margin-bottom: 0.5rem;
-}
+# ─────────────────────────────────────────────────
+# Document retrieval (BM25)
+# ─────────────────────────────────────────────────
 
-/* ── Hide sidebar collapse & expand buttons (sidebar is always visible) ── */
-[data-testid="stSidebarCollapseButton"],
-[data-testid="collapsedControl"] {
-    display: none !important;
-    visibility: hidden !important;
-    pointer-events: none !important;
-}
+_STOPWORDS = frozenset(
+    "a o as os e de da do das dos em no na nos nas um uma uns umas por para com "
+    "sem que se ou ao aos como mais mas foi ser sao the of and to in is it for on "
+    "with as by an be this that are or from at".split()
+)
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _tokenize(text: str) -> list[str]:
+    """Lowercase, accent-folded word tokens without stopwords ("ação" → "acao")."""
+    folded = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode()
+    return [t for t in _TOKEN_RE.findall(folded) if len(t) > 1 and t not in _STOPWORDS]
+
+
+class BM25Index:
+    """In-memory inverted index over document chunks, ranked with Okapi BM25."""
+
+    def __init__(self, chunks=(), k1: float = 1.5, b: float = 0.75):
+        self.chunks: list[dict] = []
+        self.k1, self.b = k1, b
+        self.postings: dict[str, list[tuple[int, int]]] = {}
+        self.lengths: list[int] = []
+        self._total_len = 0
+        self.chars = 0
+        for chunk in chunks:
+            self.add(chunk)
+
+    def add(self, chunk: dict):
+        """Index one more chunk; cost depends only on the chunk, not the index size."""
+        idx = len(self.chunks)
+        self.chunks.append(chunk)
+        tf: dict[str, int] = {}
+        for tok in _tokenize(chunk["text"]):
+            tf[tok] = tf.get(tok, 0) + 1
+        for tok, n in tf.items():
+            self.postings.setdefault(tok, []).append((idx, n))
+        length = sum(tf.values())
+        self.lengths.append(length)
+        self._total_len += length
+        self.chars += len(chunk["text"])
+
+    @property
+    def avgdl(self) -> float:
+        return self._total_len / len(self.lengths) if self.lengths else 0.0
+
+    @property
+    def total_len(self) -> int:
+        return self._total_len
+
+    def search(self, query: str, k: int, stats: tuple[int, float, dict[str, int]] | None = None
+               ) -> list[tuple[float, int]]:
+        """Top-k (score, chunk index) pairs for the query, best first.
+
+        `stats` = (chunk count, average chunk length, per-token chunk frequency) of
+        a corpus this index is one part of, so scores compare across its parts.
+        """
+        n_docs, avgdl = len(self.chunks), self.avgdl or 1.0
+        df: dict[str, int] = {}
+        if stats is not None:
+            n_docs, avgdl, df = stats
+        scores: dict[int, float] = {}
+        for tok in set(_tokenize(query)):
+            postings = self.postings.get(tok)
+            if not postings:
+                continue
+            n = df.get(tok, len(postings))
+            idf = math.log(1 + (n_docs - n + 0.5) / (n + 0.5))
+            for idx, tf in postings:
+                norm = tf + self.k1 * (1 - self.b + self.b * self.lengths[idx] / avgdl)
+                scores[idx] = scores.get(idx, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(k, ((sc, idx) for idx, sc in scores.items()))
+
+
+class VectorIndex:
+    """Chunk embeddings as one contiguous, L2-normalised float32 matrix.
+
+    Rows are unit vectors, so cosine similarity against a query is a single
+    matrix-vector product.
+    """
+
+    def __init__(self, matrix: np.ndarray):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.matrix = np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+    @classmethod
+    def build(cls, texts: list[str], embed_fn=ollama_embed, batch_size: int = EMBED_BATCH):
+        rows = []
+        for start in range(0, len(texts), batch_size):
+            rows.extend(embed_fn(texts[start:start + batch_size]))
+        return cls(np.asarray(rows, dtype=np.float32).reshape(len(texts), -1))
+
+    def search(self, query_vec, k: int) -> list[tuple[float, int]]:
+        """Top-k (cosine similarity, row index) pairs, best first."""
+        n = self.matrix.shape[0]
+        if n == 0:
+            return []
+        q = np.asarray(query_vec, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1.0
+        scores = self.matrix @ q
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(i)) for i in top]
+
+
+class EmbeddingStore:
+    """Process-wide LRU of VectorIndex objects keyed by document hash and model.
+
+    A document is embedded once and reused by every turn, conversation and
+    session that attaches it.
+    """
+
+    def __init__(self, max_docs: int = EMBED_CACHE_DOCS):
+        self.max_docs = max_docs
+        self._lock = threading.Lock()
+        self._items: OrderedDict[tuple, VectorIndex] = OrderedDict()
+        # key -> [build lock, callers holding or waiting for it]
+        self._building: dict[tuple, list] = {}
+
+    def get(self, doc_key: str, model: str = EMBED_MODEL) -> VectorIndex | None:
+        """The stored index, without building it when absent."""
+        with self._lock:
+            index = self._items.get((doc_key, model))
+            if index is not None:
+                self._items.move_to_end((doc_key, model))
+            return index
+
+    def get_or_build(self, doc_key: str, texts: list[str], embed_fn=ollama_embed,
+                     model: str = EMBED_MODEL) -> VectorIndex:
+        key = (doc_key, model)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+            building = self._building.setdefault(key, [threading.Lock(), 0])
+            building[1] += 1
+        try:
+            # One builder per document; concurrent sessions wait for it instead of re-embedding
+            with building[0]:
+                with self._lock:
+                    if key in self._items:
+                        return self._items[key]
+                index = VectorIndex.build(texts, embed_fn)
+                with self._lock:
+                    self._items[key] = index
+                    while len(self._items) > self.max_docs:
+                        self._items.popitem(last=False)
+                return index
+        finally:
+            # Released on failures too (embedding model not pulled, host down)
+            with self._lock:
+                building[1] -= 1
+                if not building[1]:
+                    self._building.pop(key, None)
+
+
+@st.cache_resource(show_spinner=False)
+def _embedding_store() -> EmbeddingStore:
+    return EmbeddingStore()
+
+
+class CorpusDocument:
+    """One attached document: metadata and BM25 corpus statistics always in
+    memory, its index only while hot."""
+
+    __slots__ = ("name", "digest", "kind", "chars", "n_chunks", "tokens", "df", "vec_key",
+                 "index", "vectors")
+
+    def __init__(self, name: str, digest: str, kind: str, index: BM25Index,
+                 vectors: VectorIndex | None = None):
+        self.name, self.digest, self.kind = name, digest, kind
+        self.chars, self.n_chunks, self.tokens = index.chars, len(index.chunks), index.total_len
+        # Chunks containing each token: corpus-wide BM25 stats without loading the index
+        self.df = {tok: len(postings) for tok, postings in index.postings.items()}
+        # Where its embeddings live in the EmbeddingStore once the document is spilled
+        self.vec_key = chunks_key(index.chunks) if vectors is not None else None
+        self.index: BM25Index | None = index
+        self.vectors = vectors
+
+
+class DocumentCorpus:
+    """Every document attached in one session, grouped by conversation.
+
+    Indexes stay in memory in LRU order up to `max_chars` of indexed text; past
+    that the coldest documents are spilled: their index is dropped and rebuilt
+    from the on-disk text cache, transiently, whenever a query needs it. Documents the
+    text cache can't read back are never spilled, and the one in use never is.
+    """
+
+    def __init__(self, max_chars: int, text_cache: DocumentTextCache):
+        self.max_chars = max_chars
+        self.text_cache = text_cache
+        self._convs: dict[str, OrderedDict[str, CorpusDocument]] = {}
+        self._hot: OrderedDict[CorpusDocument, None] = OrderedDict()
+        self.hot_chars = 0
+
+    def documents(self, cid: str) -> list[CorpusDocument]:
+        return list(self._convs.get(cid, {}).values())
+
+    def has(self, cid: str, digest: str) -> bool:
+        return digest in self._convs.get(cid, {})
+
+    def key(self, cid: str) -> str | None:
+        """Identity of a conversation's corpus (order-independent), or None when empty."""
+        digests = sorted(self._convs.get(cid, {}))
+        if not digests:
+            return None
+        return hashlib.sha256("\0".join(digests).encode()).hexdigest()
+
+    def add(self, cid: str, doc: CorpusDocument) -> CorpusDocument:
+        docs = self._convs.setdefault(cid, OrderedDict())
+        if doc.digest in docs:
+            return docs[doc.digest]
+        docs[doc.digest] = doc
+        self._warm(doc)
+        return doc
+
+    def remove(self, cid: str, digest: str):
+        doc = self._convs.get(cid, {}).pop(digest, None)
+        if doc is not None:
+            self._spill(doc)
+
+    def drop(self, cid: str):
+        for doc in self._convs.pop(cid, {}).values():
+            self._spill(doc)
+
+    def chunks(self, doc: CorpusDocument):
+        """Iterate the document's chunks: from its index while hot, else re-chunked
+        page by page from the text cache."""
+        if doc.index is not None:
+            yield from doc.index.chunks
+            return
+        for page_no, _, text in self.text_cache.iter_pages(None, doc.digest):
+            yield from chunk_page(page_no, text)
+
+    def index(self, doc: CorpusDocument) -> BM25Index:
+        """The document's index. A spilled document is rebuilt for the caller only
+        and stays spilled, so a query never holds more than one rebuilt index."""
+        if doc.index is None:
+            return BM25Index(self.chunks(doc))
+        self._warm(doc)
+        return doc.index
+
+    def vectors(self, doc: CorpusDocument) -> VectorIndex | None:
+        """The document's embeddings: its own while hot, else the EmbeddingStore's
+        copy if still there (never re-embedded for a query)."""
+        if doc.index is not None:
+            return doc.vectors
+        return _embedding_store().get(doc.vec_key) if doc.vec_key else None
+
+    def _warm(self, doc: CorpusDocument):
+        if doc in self._hot:
+            self._hot.move_to_end(doc)
+            return
+        self._hot[doc] = None
+        self.hot_chars += doc.chars
+        for cold in list(self._hot):
+            if self.hot_chars <= self.max_chars:
+                break
+            if cold is not doc and self.text_cache.has(cold.digest):
+                self._spill(cold)
+
+    def _spill(self, doc: CorpusDocument):
+        if doc in self._hot:
+            del self._hot[doc]
+            self.hot_chars -= doc.chars
+        doc.index = doc.vectors = None
+
+
+def _rrf(rankings: list[list], k: int = 60) -> list:
+    """Reciprocal-rank fusion of several best-first rankings."""
+    scores: dict = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def select_context(corpus: DocumentCorpus, cid: str, query: str, top_k: int = DOC_TOP_K,
+                   budget: int = DOC_CONTEXT_CHARS, embed_fn=ollama_embed
+                   ) -> list[tuple[CorpusDocument, dict]]:
+    """Best-matching (document, chunk) pairs for `query` that fit in `budget` chars
+    (each excerpt counted with its "[name, p. N] " label).
+
+    BM25 runs over the conversation's whole corpus (chunk counts, lengths and
+    term frequencies summed across documents, so a chunk from one paper ranks
+    against chunks from all of them); documents with embeddings add a cosine
+    ranking, fused with BM25 (RRF). Falls back to each document's opening
+    chunks when nothing matches (e.g. "resuma os documentos"). Results come in
+    corpus order, then page order.
+    """
+    docs = corpus.documents(cid)
+    if not docs:
+        return []
+    tokens = set(_tokenize(query))
+    n_chunks = sum(d.n_chunks for d in docs)
+    avgdl = (sum(d.tokens for d in docs) / n_chunks) if n_chunks else 1.0
+    df = {tok: sum(d.df.get(tok, 0) for d in docs) for tok in tokens}
+    stats = (n_chunks, avgdl or 1.0, df)
+
+    vectors = [corpus.vectors(d) for d in docs]
+    query_vec = None
+    if EMBED_MODEL and any(v is not None for v in vectors):
+        try:
+            query_vec = embed_fn([query])[0]
+        except Exception as e:
+            log.warning("query embedding failed, using BM25 only: %s", e)
+
+    # One document at a time, keeping only its candidates: a spilled document is
+    # rebuilt for this query and released before the next one is read, and one
+    # sharing no term with the query (and without embeddings) isn't read at all
+    chunks: dict[tuple[int, int], dict] = {}
+    lexical, semantic = [], []
+    for pos, doc in enumerate(docs):
+        use_vectors = query_vec is not None and vectors[pos] is not None
+        if not use_vectors and not any(tok in doc.df for tok in tokens):
+            continue
+        try:
+            index = corpus.index(doc)
+        except (OSError, ValueError) as e:
+            # Spilled, then its text left the disk cache
+            log.warning("document %s can no longer be read, leaving it out: %s", doc.name, e)
+            continue
+        for score, idx in index.search(query, top_k * 2, stats):
+            lexical.append((score, (pos, idx)))
+            chunks[pos, idx] = index.chunks[idx]
+        if use_vectors:
+            for score, idx in vectors[pos].search(query_vec, top_k * 2):
+                semantic.append((score, (pos, idx)))
+                chunks[pos, idx] = index.chunks[idx]
+        del index
+    rankings = [[key for _, key in heapq.nlargest(top_k * 2, found)] for found in (lexical, semantic) if found]
+    ranked = _rrf(rankings) if len(rankings) > 1 else (rankings[0] if rankings else [])
+    if not ranked:
+        # Opening chunks of every document in turn (only those pages are read)
+        for pos, doc in enumerate(docs):
+            try:
+                for idx, chunk in enumerate(islice(corpus.chunks(doc), top_k)):
+                    chunks[pos, idx] = chunk
+            except (OSError, ValueError) as e:
+                log.warning("document %s can no longer be read, leaving it out: %s", doc.name, e)
+        ranked = sorted(chunks, key=lambda key: (key[1], key[0]))
+
+    picked, used = [], 0
+    for key in ranked:
+        size = len(chunks[key]["text"]) + len(docs[key[0]].name) + 16
+        if used + size > budget:
+            if picked:
+                break
+            continue
+        picked.append(key)
+        used += size
+        if len(picked) >= top_k:
+            break
+    return [(docs[pos], chunks[pos, idx]) for pos, idx in sorted(picked)]
+
+
+def chunks_key(chunks: list[dict]) -> str:
+    """Content hash of a chunked document, its key in the EmbeddingStore."""
+    digest = hashlib.sha256()
+    for c in chunks:
+        digest.update(c["text"].encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def embed_chunks(chunks: list[dict], embed_fn=ollama_embed) -> VectorIndex | None:
+    """Shared VectorIndex for a chunked document, or None if embeddings are unavailable."""
+    if not EMBED_MODEL or not chunks:
+        return None
+    try:
+        return _embedding_store().get_or_build(chunks_key(chunks), [c["text"] for c in chunks], embed_fn)
+    except Exception as e:
+        log.warning("embedding %d chunks failed, semantic search disabled: %s", len(chunks), e)
+        return None
 
-/* ── Footer ── */
-.gurugpt-footer {
-    position: fixed;
-    bottom: 0;
-    left: 0;
-    right: 0;
-    text-align: center;
-    padding: 0.55rem 1rem;
-    font-size: 0.75rem;
-    color: #6b6a8a;
-    background: rgba(13,13,20,0.92);
-    backdrop-filter: blur(8px);
-    border-top: 1px solid #1e1e32;
-    z-index: 1000;
-    letter-spacing: 0.3px;
-    font-family: var(--font-main);
-}
-.gurugpt-footer span {
-    color: #ef4444;
-}
-/* Push chat content above footer */
-[data-testid="stMain"] .block-container {
-    padding-bottom: 3rem !important;
-}
 
-/* Botão ☰ e backdrop mobile — ocultos por padrão (desktop); @media mobile os reexibe */
-#mobile-menu-btn { display: none !important; }
-#mobile-sidebar-backdrop { display: none; }
-
-
-/* ═══════════════════════════════════════════════════
-   RESPONSIVIDADE MOBILE  (≤ 768 px)
-   ═══════════════════════════════════════════════════ */
-@media (max-width: 768px) {
-
-    /* ── Sidebar vira overlay deslizante ── */
-    [data-testid="stSidebar"] {
-        position: fixed !important;
-        top: 0 !important;
-        left: 0 !important;
-        height: 100dvh !important;
-        width: 82vw !important;
-        min-width: unset !important;
-        max-width: 320px !important;
-        z-index: 9999 !important;
-        transform: translateX(-100%) !important;
-        transition: transform 0.28s cubic-bezier(.4,0,.2,1) !important;
-        resize: none !important;
-        box-shadow: 4px 0 32px rgba(0,0,0,0.65);
-        overflow-y: auto !important;
-        translate: none !important; /* override do CSS desktop */
-    }
+# ─────────────────────────────────────────────────
+# Context budget
+# ─────────────────────────────────────────────────
 
-    [data-testid="stSidebar"].mobile-open {
-        transform: translateX(0) !important;
+# Portuguese/English prose averages about this many characters per token
+CHARS_PER_TOKEN = 3.5
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate from CHARS_PER_TOKEN."""
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def _message_tokens(msg: dict) -> int:
+    return estimate_tokens(msg["content"]) + 4  # role + chat-template framing
+
+
+def _summarize_dropped(dropped: list[dict], budget: int) -> str:
+    """Extractive note listing the user questions of omitted turns, newest first."""
+    questions = [m["content"] for m in reversed(dropped) if m["role"] == "user"]
+    note = f"[{len(dropped)} mensagens anteriores omitidas por limite de contexto. Perguntas do usuário:"
+    for q in questions:
+        line = "\n- " + " ".join(q.split())[:100]
+        if estimate_tokens(note + line) > budget:
+            break
+        note += line
+    return note + "]"
+
+
+def _clip_middle(text: str, max_tokens: int) -> str:
+    """`text` cut down to about `max_tokens`, keeping its start and end."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    keep = max(int(max_tokens * CHARS_PER_TOKEN) - 48, 0)
+    head, tail = keep - keep // 2, keep // 2
+    omitted = len(text) - head - tail
+    return f"{text[:head]}\n[… {omitted} caracteres omitidos …]\n{text[len(text) - tail:]}"
+
+
+def context_budget(model: str, system_content: str, prompt: str, cap: int = DOC_CONTEXT_CHARS) -> int:
+    """Characters of document excerpts this turn can carry, at most `cap`.
+
+    Half of what the window leaves after the reply reserve, the system prompt,
+    the prompt and the history summary's share; the other half stays for
+    recent history.
+    """
+    window = min(model_context_length(model), CONTEXT_MAX_TOKENS)
+    free = (window - CONTEXT_REPLY_TOKENS - estimate_tokens(system_content) - estimate_tokens(prompt)
+            - max(64, int(window * CONTEXT_SUMMARY_SHARE)) - 16)
+    return max(0, min(cap, int(free / 2 * CHARS_PER_TOKEN)))
+
+
+def build_api_messages(model: str, system_content: str, history: list[dict], prompt: str,
+                       context: str = "", floor: int = 0) -> tuple[list[dict], dict, dict]:
+    """Fit system prompt, history, document context and the prompt into the model's window.
+
+    Layout is prefix-stable so Ollama can reuse its KV cache across turns:
+    the static system prompt, then history from `floor` on (older turns replaced
+    by a fixed summary), then everything that changes per turn — retrieved
+    document `context` and the prompt — in the final user message.
+
+    History is only trimmed when it overflows, and then down to
+    CONTEXT_REFILL_SHARE of the budget at once, on a user-message boundary;
+    the caller keeps the returned report["floor"] for the next turn. Returns
+    (messages, options, report); options carry num_ctx so Ollama's window
+    matches the budget.
+    """
+    window = min(model_context_length(model), CONTEXT_MAX_TOKENS)
+    budget = window - CONTEXT_REPLY_TOKENS
+    # The stop note on interrupted replies is for the reader, not the model
+    history = [
+        dict(m, content=m["content"].removesuffix(STOPPED_NOTE)) if m["content"].endswith(STOPPED_NOTE) else m
+        for m in history
+    ]
+    system = {"role": "system", "content": system_content}
+    summary_budget = max(64, int(window * CONTEXT_SUMMARY_SHARE))
+    # `context` comes sized by context_budget(); a prompt too long for what is
+    # left is cut in the middle rather than overflowing the window
+    room = budget - _message_tokens(system) - summary_budget - (estimate_tokens(context) + 4 if context else 8)
+    sent = _clip_middle(prompt, room)
+    user = {"role": "user", "content": f"{context}\n\n{sent}" if context else sent}
+    fixed = _message_tokens(system) + _message_tokens(user)
+
+    floor = min(floor, len(history))
+    tail = sum(map(_message_tokens, history[floor:]))
+    if fixed + tail + (summary_budget if floor else 0) > budget:
+        # Overflow: move the floor forward until the history fills the refill target,
+        # always cutting on a user message so history never starts with a reply
+        target = (budget - summary_budget - fixed) * CONTEXT_REFILL_SHARE
+        new_floor, running = len(history), 0
+        for i in range(len(history) - 1, floor - 1, -1):
+            running += _message_tokens(history[i])
+            if running > target:
+                break
+            if history[i]["role"] == "user":
+                new_floor = i
+        floor = new_floor
+
+    kept, dropped = history[floor:], history[:floor]
+    api_messages = [system]
+    if dropped:
+        api_messages.append({"role": "system", "content": _summarize_dropped(dropped, summary_budget)})
+    api_messages += kept + [user]
+
+    report = {
+        "model": model,
+        "window": window,
+        "prompt_tokens_est": sum(map(_message_tokens, api_messages)),
+        "history_kept": len(kept),
+        "history_dropped": len(dropped),
+        "floor": floor,
+        "prompt_clipped": len(prompt) - len(sent) if sent is not prompt else 0,
     }
+    return api_messages, {"num_ctx": window}, report
 
-    /* Backdrop escuro atrás do menu */
-    #mobile-sidebar-backdrop {
-        display: none;
-        position: fixed;
-        inset: 0;
-        background: rgba(0,0,0,0.55);
-        z-index: 9998;
-        backdrop-filter: blur(2px);
-        -webkit-backdrop-filter: blur(2px);
-    }
-    #mobile-sidebar-backdrop.visible { display: block; }
-
-    /* Botão ☰ flutuante para abrir o menu */
-    #mobile-menu-btn {
-        display: flex !important;
-        position: fixed;
-        top: 14px;
-        left: 14px;
-        z-index: 10000;
-        width: 44px;
-        height: 44px;
-        border-radius: 12px;
-        background: linear-gradient(135deg, #7c3aed, #4f46e5);
-        color: white;
-        font-size: 1.3rem;
-        border: none;
-        cursor: pointer;
-        align-items: center;
-        justify-content: center;
-        box-shadow: 0 4px 20px rgba(124,58,237,0.55);
-        transition: transform 0.15s ease;
-        -webkit-tap-highlight-color: transparent;
-    }
-    #mobile-menu-btn:active { transform: scale(0.9); }
 
-    /* Área principal — sem margem do sidebar */
-    [data-testid="stMain"] {
-        margin-left: 0 !important;
-        width: 100vw !important;
-    }
+# ─────────────────────────────────────────────────
+# Response cache
+# ─────────────────────────────────────────────────
 
-    [data-testid="stMain"] .block-container {
-        padding: 4.2rem 0.75rem 5rem !important;
-        max-width: 100% !important;
-    }
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).casefold()
 
-    /* Logo compacta */
-    .gurugpt-logo { padding: 0.4rem 0 0.2rem; }
-    .gurugpt-logo .icon-wrap {
-        width: 50px; height: 50px;
-        font-size: 1.55rem; border-radius: 14px;
-        margin-bottom: 7px;
-    }
-    .gurugpt-logo h1 { font-size: 1.85rem; }
-    .gurugpt-logo p  { font-size: 0.76rem; }
 
-    /* Mensagens */
-    .stChatMessageContent {
-        padding: 0.6rem 0.85rem !important;
-        font-size: 0.91rem !important;
-    }
+def response_cache_key(model: str, api_messages: list[dict], prompt: str, doc_hash: str | None) -> str:
+    """Model + normalised system prompt(s) + attached document + history tail + prompt.
 
-    /* Blocos de código — scroll horizontal */
-    pre {
-        font-size: 0.77rem !important;
-        padding: 0.7rem !important;
-        border-radius: 8px !important;
-        overflow-x: auto !important;
-        -webkit-overflow-scrolling: touch;
-    }
+    Retrieved excerpts are left out on purpose: they follow from the document,
+    the prompt and the previous question, which are all in the key.
+    """
+    system = [m["content"] for m in api_messages if m["role"] == "system"]
+    history = [m for m in api_messages[len(system):-1]][-RESPONSE_CACHE_TAIL:] if RESPONSE_CACHE_TAIL else []
+    parts = [model, *map(_normalize, system), doc_hash or "",
+             *(f"{m['role']}:{_normalize(m['content'])}" for m in history), _normalize(prompt)]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
 
-    /* Input de chat */
-    [data-testid="stChatInput"] textarea {
-        font-size: 1rem !important;
-        min-height: 48px !important;
-    }
 
-    /* Botões maiores para toque */
-    .stButton > button {
-        min-height: 44px !important;
-        font-size: 0.93rem !important;
-    }
+class ResponseCache:
+    """Process-wide LRU + TTL cache of finished replies, with hit/miss counters."""
 
-    /* Footer compacto */
-    .gurugpt-footer {
-        font-size: 0.66rem;
-        padding: 0.38rem 0.5rem;
-    }
+    def __init__(self, max_items: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.max_items, self.ttl = max_items, ttl
+        self._lock = threading.Lock()
+        self._items: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits = self.misses = 0
 
-    /* Selectbox fullwidth */
-    .stSelectbox { width: 100% !important; }
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.monotonic():
+                self._items.pop(key, None)
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: str, text: str):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, text)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._items),
+                    "hit_rate": self.hits / total if total else 0.0}
 
-    /* Ocultar botão reabrir sidebar do desktop no mobile */
-    #gurugpt-sidebar-open-btn { display: none !important; }
-}
 
-/* Telas muito pequenas (≤ 380 px — iPhone SE, Galaxy A) */
-@media (max-width: 380px) {
-    .gurugpt-logo h1 { font-size: 1.55rem; }
-    .gurugpt-logo .icon-wrap { width: 42px; height: 42px; font-size: 1.3rem; }
-    [data-testid="stMain"] .block-container { padding: 3.8rem 0.5rem 5rem !important; }
+@st.cache_resource(show_spinner=False)
+def _response_cache() -> ResponseCache:
+    return ResponseCache()
+
+
+def replay_cached(text: str, size: int = 64):
+    """Yield a cached reply in stream-sized pieces so it goes through the same renderer."""
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+# ─────────────────────────────────────────────────
+# Telemetry (Prometheus text format)
+# ─────────────────────────────────────────────────
+
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120)
+
+# name -> (type, help, buckets)
+METRIC_SPECS = {
+    "gurugpt_ttft_seconds": ("histogram", "Time from send to first streamed token.", _LATENCY_BUCKETS),
+    "gurugpt_queue_wait_seconds": ("histogram", "Time spent waiting for a scheduler slot.", _LATENCY_BUCKETS),
+    "gurugpt_prefill_seconds": ("histogram", "Ollama prompt evaluation time (prompt_eval_duration).", _LATENCY_BUCKETS),
+    "gurugpt_model_load_seconds": ("histogram", "Ollama model load time (load_duration).", _LATENCY_BUCKETS),
+    "gurugpt_decode_tokens_per_second": (
+        "histogram", "Decode speed (eval_count / eval_duration).", (1, 2, 5, 10, 20, 40, 80, 160, 320)),
+    "gurugpt_response_bytes": (
+        "histogram", "UTF-8 bytes of each reply.", (256, 1024, 4096, 16384, 65536, 262144)),
+    "gurugpt_generations_total": ("counter", "Replies served, by source (ollama, cache or cancelled).", None),
+    "gurugpt_prompt_tokens_total": ("counter", "Prompt tokens evaluated by Ollama.", None),
+    "gurugpt_completion_tokens_total": ("counter", "Tokens generated by Ollama.", None),
+    "gurugpt_cancelled_tokens_total": ("counter", "Tokens streamed by replies before they were stopped.", None),
+    "gurugpt_cancel_saved_tokens_total": (
+        "counter", "Estimated tokens not generated thanks to stopped replies "
+        "(the model's mean reply length, or the reply reserve, minus what was streamed).", None),
+    "gurugpt_render_frames_total": ("counter", "Placeholder redraws sent while streaming.", None),
+    "gurugpt_render_bytes_total": ("counter", "Markdown bytes sent to browsers while streaming.", None),
+    "gurugpt_prompt_tokens_estimated_total": (
+        "counter", "Prompt tokens as estimated when fitting the window (compare with "
+        "gurugpt_prompt_tokens_total, which leaves out Ollama prefix-cache hits).", None),
+    "gurugpt_context_trimmed_total": ("counter", "Replies whose older history was summarized to fit the window.", None),
+    "gurugpt_prompt_clipped_total": ("counter", "Replies whose prompt was cut in the middle to fit the window.", None),
 }
-</style>
-"""
 
-# ═══════════════════════════════════════════════════════════════
-# MOBILE ☰ BUTTON — rendered as STATIC HTML (never created by JS)
-# Two overlapping spans inside the button: .gg-ham (☰) and .gg-x (✕).
-# CSS transitions swap them when #gg-btn has class 'open'.
-# ═══════════════════════════════════════════════════════════════
-MOBILE_BTN_HTML = (
-    '<div id="gg-wrap-2" style="'
-    'position:fixed;top:14px;left:14px;z-index:2147483647;'
-    'display:none;">'
-    '<button id="gg-btn-2" title="Abrir/fechar menu" style="'
-    'position:relative;width:48px;height:48px;border-radius:14px;'
-    'background:linear-gradient(135deg,#7c3aed,#4f46e5);'
-    'color:white;font-size:1.5rem;border:none;cursor:pointer;'
-    'display:flex;align-items:center;justify-content:center;'
-    'box-shadow:0 4px 24px rgba(124,58,237,0.65);'
-    '-webkit-tap-highlight-color:transparent;user-select:none;'
-    'overflow:hidden;">'
-    # Two layered icons
-    '<span class="gg-ham" style="'
-    'position:absolute;transition:opacity .25s,transform .25s;'
-    'opacity:1;transform:rotate(0deg);">&#9776;</span>'
-    '<span class="gg-x" style="'
-    'position:absolute;transition:opacity .25s,transform .25s;'
-    'opacity:0;transform:rotate(-90deg);font-size:1.2rem;">&#10005;</span>'
-    '</button></div>'
-    # Backdrop
-    '<div id="gg-bd" '
-    'style="'
-    'display:none;position:fixed;inset:0;'
-    'background:rgba(0,0,0,0.55);'
-    'backdrop-filter:blur(3px);-webkit-backdrop-filter:blur(3px);'
-    'z-index:9997;"></div>'
-    # CSS: show/hide + transition
-    '<style>'
-    '@media(max-width:768px){#gg-wrap-2{display:flex!important;}}'
-    '@media(min-width:769px){#gg-wrap-2,#gg-bd{display:none!important;}}'
-    # Open state: when body has class 'gg-sidebar-open', swap icons
-    'body.gg-sidebar-open #gg-btn-2 .gg-ham{opacity:0!important;transform:rotate(90deg)!important;}'
-    'body.gg-sidebar-open #gg-btn-2 .gg-x{opacity:1!important;transform:rotate(0deg)!important;}'
-    '#gg-btn-2:active{transform:scale(0.86);}'
-    '</style>'
-)
 
-# ═══════════════════════════════════════════════════════════════════
-# TOGGLE_COMPONENT_HTML — injected via st.components.v1.html(height=0)
-#
-# Why components.v1.html instead of st.markdown?
-#   st.markdown <script> tags: Streamlit re-executes them via createElement
-#   but timing with React's rendering is unreliable. The iframe created by
-#   components.v1.html() executes scripts synchronously and has same-origin
-#   access to window.parent.document (both served from localhost:8501).
-#
-# Strategy:
-#   1. Access parent document from iframe (window.parent)
-#   2. Define _ggOpen / _ggClose in the PARENT window scope
-#   3. Use MutationObserver on parent.body to detect gg-wrap instantly
-#   4. Move gg-wrap + gg-bd to parent.body (escape React's managed tree)
-#   5. addEventListener works correctly outside React tree (no Error #231)
-#   6. setProperty(prop, val, 'important') overrides all CSS !important rules
-# ═══════════════════════════════════════════════════════════════════
-TOGGLE_COMPONENT_HTML = """<!DOCTYPE html><html><body style="margin:0;padding:0;overflow:hidden">
-<script>
-(function(){
-  var P  = window.parent;        /* Parent window (main Streamlit page)  */
-  var PD = P.document;           /* Parent document                      */
-  var PB = PD.body;              /* Parent body                          */
-
-  /* ── _ggOpen / _ggClose: toggle the drawer ── */
-  P._ggOpen = function() {
-    var sb = PD.querySelector('[data-testid="stSidebar"]');
-    /* Toggle: if already open → close */
-    if (sb && sb.classList.contains('mobile-open')) {
-      P._ggClose();
-      return;
-    }
-    if (sb) {
-      sb.classList.add('mobile-open');
-      [['position','fixed'],['top','0'],['left','0'],['width','82vw'],
-       ['max-width','320px'],['height','100dvh'],['transform','translateX(0)'],
-       ['translate','none'],['display','flex'],['visibility','visible'],
-       ['opacity','1'],['z-index','99999'],['overflow-y','auto']
-      ].forEach(function(p){ sb.style.setProperty(p[0],p[1],'important'); });
-    }
-    /* Animate button ☰ → ✕ (by adding class to BODY, persistent across re-renders) */
-    if (PD.body) PD.body.classList.add('gg-sidebar-open');
-    var bd = PD.getElementById('gg-bd');
-    if (bd) bd.style.display = 'block';
-  };
-  P._ggClose = function() {
-    var sb = PD.querySelector('[data-testid="stSidebar"]');
-    if (sb) {
-      sb.classList.remove('mobile-open');
-      ['position','top','left','width','max-width','height','transform',
-       'translate','display','visibility','opacity','z-index','overflow-y'
-      ].forEach(function(p){ sb.style.removeProperty(p); });
-    }
-    /* Animate button ✕ → ☰ */
-    if (PD.body) PD.body.classList.remove('gg-sidebar-open');
-    var bd = PD.getElementById('gg-bd');
-    if (bd) bd.style.display = 'none';
-  };
-
-  /* ── Adopt button + backdrop: move to parent.body, attach handlers ── */
-  var _btnReady = false;
-  function adoptBtn() {
-    if (_btnReady) return;
-    var wrap = PD.getElementById('gg-wrap-2');
-    var btn  = PD.getElementById('gg-btn-2');
-    var bd   = PD.getElementById('gg-bd');
-    if (!wrap || !btn) return;
-
-    /* Move elements out of React's managed tree */
-    if (wrap.parentElement !== PB) PB.appendChild(wrap);
-    if (bd && bd.parentElement !== PB) PB.appendChild(bd);
-
-    /* Attach click handlers (safe outside React tree) */
-    btn.addEventListener('click', P._ggOpen);
-    if (bd) bd.addEventListener('click', P._ggClose);
-
-    /* Swipe left → close */
-    var tx = 0;
-    PD.addEventListener('touchstart',function(e){tx=e.changedTouches[0].screenX;},{passive:true});
-    PD.addEventListener('touchend',function(e){
-      if(e.changedTouches[0].screenX-tx<-60) P._ggClose();
-    },{passive:true});
-
-    _btnReady = true;
-  }
-
-  /* MutationObserver: fires the instant gg-wrap appears in the DOM */
-  var obs = new MutationObserver(function(){ adoptBtn(); });
-  obs.observe(PB, {childList:true, subtree:true});
-  adoptBtn(); /* also try immediately in case already in DOM */
-
-  /* ── Desktop floating reopen button ── */
-  var DESK_ID = 'gurugpt-sidebar-open-btn';
-  function ensureDesktop() {
-    var b = PD.getElementById(DESK_ID);
-    if (!b) {
-      b = PD.createElement('button');
-      b.id = DESK_ID;
-      b.title = 'Abrir painel lateral';
-      b.innerHTML = '&#9776;';
-      Object.assign(b.style, {
-        position:'fixed', top:'50vh', left:'0',
-        transform:'translateY(-50%)', zIndex:'2147483646',
-        background:'linear-gradient(180deg,#7c3aed,#4f46e5)',
-        color:'white', border:'none', borderRadius:'0 14px 14px 0',
-        width:'40px', height:'56px', fontSize:'1.2rem',
-        cursor:'pointer', display:'none',
-        alignItems:'center', justifyContent:'center',
-        boxShadow:'4px 0 24px rgba(124,58,237,0.75)',
-        transition:'width .2s', fontFamily:'sans-serif', lineHeight:'1',
-      });
-      b.addEventListener('mouseenter',function(){b.style.width='50px';});
-      b.addEventListener('mouseleave',function(){b.style.width='40px';});
-      b.addEventListener('click',function(){
-        var t = PD.querySelector('[data-testid="collapsedControl"] button')
-             || PD.querySelector('[data-testid="stSidebarCollapseButton"] button');
-        if (t) t.click();
-      });
-      PB.appendChild(b);
-      var pt=0;
-      setInterval(function(){
-        pt+=0.05;
-        var g=0.55+0.3*Math.sin(pt);
-        b.style.boxShadow='4px 0 '+Math.round(20+16*Math.sin(pt))+'px rgba(124,58,237,'+g.toFixed(2)+')';
-      },50);
-    }
-    if (P.innerWidth<=768){b.style.display='none';return;}
-    var sb=PD.querySelector('[data-testid="stSidebar"]');
-    b.style.display=(sb&&sb.getBoundingClientRect().width>60)?'none':'flex';
-  }
-  ensureDesktop();
-  setTimeout(ensureDesktop,400);
-  setInterval(ensureDesktop,1500);
-  P.addEventListener('resize',ensureDesktop);
-})();
-</script>
-</body></html>"""
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    esc = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, esc)) + "}"
+
+
+class Metrics:
+    """Thread-safe counters and histograms keyed by label set, rendered for Prometheus.
+
+    Collectors registered with add_collector are called at render time for
+    values owned by other components (scheduler, response cache).
+    """
+
+    def __init__(self, specs: dict = METRIC_SPECS):
+        self.specs = specs
+        self._lock = threading.Lock()
+        # name -> {label tuple: float | [bucket counts..., sum, count]}
+        self._series: dict[str, dict[tuple, object]] = {name: {} for name in specs}
+        self._collectors = []
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series[name]
+            series[key] = series.get(key, 0.0) + value
+
+    def value(self, name: str, **labels) -> float:
+        """Current value of a counter series (0 if never incremented)."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            return self._series[name].get(key, 0.0)
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self.specs[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            state = self._series[name].setdefault(key, [0] * len(buckets) + [0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def add_collector(self, fn):
+        """fn() -> iterable of (name, type, help, [(labels dict, value), ...])."""
+        self._collectors.append(fn)
+
+    def render(self) -> str:
+        out = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in self.specs.items():
+                out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for key, value in self._series[name].items():
+                    labels = dict(key)
+                    if kind != "histogram":
+                        out.append(f"{name}{_labels(labels)} {value:g}")
+                        continue
+                    for bound, count in zip(buckets, value):
+                        out.append(f"{name}_bucket{_labels({**labels, 'le': f'{bound:g}'})} {count}")
+                    out.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {value[-1]}")
+                    out.append(f"{name}_sum{_labels(labels)} {value[-2]:g}")
+                    out.append(f"{name}_count{_labels(labels)} {value[-1]}")
+        for collector in self._collectors:
+            for name, kind, help_text, samples in collector():
+                out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                out += [f"{name}{_labels(labels)} {value:g}" for labels, value in samples]
+        return "\n".join(out) + "\n"
+
+
+def _scheduler_samples(scheduler: GenerationScheduler):
+    snap = scheduler.snapshot()
+    return [
+        ("gurugpt_scheduler_running", "gauge", "Generations holding a scheduler slot.",
+         [({"model": m}, v["running"]) for m, v in snap.items()]),
+        ("gurugpt_scheduler_waiting", "gauge", "Requests queued for a scheduler slot.",
+         [({"model": m}, v["waiting"]) for m, v in snap.items()]),
+    ]
+
+
+def _ollama_pool_samples(pool: OllamaPool):
+    snap = pool.snapshot()
+    return [
+        ("gurugpt_ollama_host_up", "gauge", "Whether the Ollama host answered its last probe.",
+         [({"host": h}, int(v["online"])) for h, v in snap.items()]),
+        ("gurugpt_ollama_host_in_flight", "gauge", "Generations currently streaming from the host.",
+         [({"host": h}, v["in_flight"]) for h, v in snap.items()]),
+    ]
+
+
+def _response_cache_samples(cache: ResponseCache):
+    stats = cache.stats()
+    return [
+        ("gurugpt_response_cache_hits_total", "counter", "Response cache hits.", [({}, stats["hits"])]),
+        ("gurugpt_response_cache_misses_total", "counter", "Response cache misses.", [({}, stats["misses"])]),
+        ("gurugpt_response_cache_entries", "gauge", "Replies held in the response cache.", [({}, stats["size"])]),
+    ]
+
+
+def _generation_samples(workers):
+    snap = workers.snapshot()
+    return [
+        ("gurugpt_generation_jobs", "gauge", "Background replies by state (finished ones await delivery).",
+         [({"state": state}, n) for state, n in snap.items()]),
+    ]
+
+
+@st.cache_resource(show_spinner=False)
+def _metrics() -> Metrics:
+    metrics = Metrics()
+    scheduler, cache, pool = _scheduler(), _response_cache(), _ollama_pool()
+    workers = _generation_workers()
+    metrics.add_collector(lambda: _scheduler_samples(scheduler))
+    metrics.add_collector(lambda: _ollama_pool_samples(pool))
+    metrics.add_collector(lambda: _response_cache_samples(cache))
+    metrics.add_collector(lambda: _generation_samples(workers))
+    return metrics
+
+
+def record_generation(model: str, stats: dict, ttft: float | None,
+                      queued: float, response: str, cached: bool, cancelled: bool = False):
+    """Record one reply's telemetry; Ollama durations arrive in nanoseconds."""
+    m = _metrics()
+    source = "cache" if cached else "cancelled" if cancelled else "ollama"
+    m.inc("gurugpt_generations_total", model=model, source=source)
+    m.observe("gurugpt_response_bytes", len(response.encode("utf-8")), model=model)
+    if ttft is not None:
+        m.observe("gurugpt_ttft_seconds", ttft, model=model)
+    if cached:
+        return
+    m.observe("gurugpt_queue_wait_seconds", queued, model=model)
+    if stats.get("prompt_eval_count") is not None:
+        m.inc("gurugpt_prompt_tokens_total", stats["prompt_eval_count"], model=model)
+        m.observe("gurugpt_prefill_seconds", (stats.get("prompt_eval_duration") or 0) / 1e9, model=model)
+    if stats.get("load_duration") is not None:
+        m.observe("gurugpt_model_load_seconds", stats["load_duration"] / 1e9, model=model)
+    if stats.get("eval_count"):
+        m.inc("gurugpt_completion_tokens_total", stats["eval_count"], model=model)
+        if stats.get("eval_duration"):
+            m.observe("gurugpt_decode_tokens_per_second",
+                      stats["eval_count"] / (stats["eval_duration"] / 1e9), model=model)
+
+
+def record_cancel(model: str, streamed: int):
+    """Record a stopped reply: tokens it streamed and an estimate of those it saved."""
+    m = _metrics()
+    completed = m.value("gurugpt_generations_total", model=model, source="ollama")
+    if completed:
+        expected = m.value("gurugpt_completion_tokens_total", model=model) / completed
+    else:
+        expected = CONTEXT_REPLY_TOKENS
+    m.inc("gurugpt_cancelled_tokens_total", streamed, model=model)
+    m.inc("gurugpt_cancel_saved_tokens_total", max(expected - streamed, 0), model=model)
+
+
+def record_context(model: str, report: dict):
+    """Record how one prompt was fitted into the model's window (build_api_messages' report)."""
+    if not report:
+        return
+    m = _metrics()
+    m.inc("gurugpt_prompt_tokens_estimated_total", report["prompt_tokens_est"], model=model)
+    if report["history_dropped"]:
+        m.inc("gurugpt_context_trimmed_total", model=model)
+    if report["prompt_clipped"]:
+        m.inc("gurugpt_prompt_clipped_total", model=model)
+
+
+def record_render(model: str, render: dict):
+    """Record what one run sent to the browser while following a reply."""
+    m = _metrics()
+    m.inc("gurugpt_render_frames_total", render["frames"], model=model)
+    m.inc("gurugpt_render_bytes_total", render["bytes"], model=model)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics: Metrics = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _write_metrics_file(metrics: Metrics, path: str, interval: float):
+    while True:
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(metrics.render())
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning("could not write metrics file %s: %s", path, e)
+        time.sleep(interval)
+
+
+@st.cache_resource(show_spinner=False)
+def _start_metrics_exporters() -> bool:
+    """Start the /metrics endpoint and/or file writer once per process."""
+    metrics = _metrics()
+    if METRICS_PORT:
+        handler = type("MetricsHandler", (_MetricsHandler,), {"metrics": metrics})
+        try:
+            server = ThreadingHTTPServer((METRICS_ADDR, METRICS_PORT), handler)
+        except OSError as e:
+            log.error("metrics endpoint not started on %s:%d: %s", METRICS_ADDR, METRICS_PORT, e)
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="gurugpt-metrics", daemon=True).start()
+    if METRICS_FILE:
+        threading.Thread(
+            target=_write_metrics_file, args=(metrics, METRICS_FILE, METRICS_FILE_INTERVAL),
+            name="gurugpt-metrics-file", daemon=True,
+        ).start()
+    return True
 
 
+# ─────────────────────────────────────────────────
+# Streaming renderer
+# ─────────────────────────────────────────────────
+
+class StreamRenderer:
+    """Coalesces streamed chunks into throttled placeholder redraws.
+
+    Code-fence state is tracked incrementally (only new chunks are scanned) and the
+    placeholder is redrawn at most `max_fps` times per second, or as soon as
+    `flush_chars` new characters have piled up.
+    """
+
+    CURSOR = "▌"
+
+    def __init__(self, placeholder, max_fps: float = STREAM_MAX_FPS,
+                 flush_chars: int = STREAM_FLUSH_CHARS):
+        self.placeholder = placeholder
+        self.interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.flush_chars = flush_chars
+        self._parts: list[str] = []
+        self._pending = 0        # chars received since the last redraw
+        self._fences = 0         # ``` fences seen so far
+        self._ticks = 0          # trailing backticks not yet part of a fence
+        self._last_flush = 0.0
+        self.frames = 0
+        self.bytes_sent = 0
+
+    @property
+    def text(self) -> str:
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def feed(self, chunk: str):
+        if not chunk:
+            return
+        self._parts.append(chunk)
+        self._pending += len(chunk)
+        self._scan(chunk)
+        now = time.monotonic()
+        if now - self._last_flush >= self.interval or self._pending >= self.flush_chars:
+            self._flush(cursor=True, now=now)
+
+    def _scan(self, chunk: str):
+        # Same result as text.count("```") on the whole reply, but O(len(chunk)):
+        # a fence split across chunks is stitched back with the carried backticks.
+        if "`" not in chunk:
+            self._ticks = 0
+            return
+        seq = "`" * self._ticks + chunk
+        self._fences += seq.count("```")
+        self._ticks = (len(seq) - len(seq.rstrip("`"))) % 3
+
+    @property
+    def in_code_block(self) -> bool:
+        return self._fences % 2 == 1
+
+    @staticmethod
+    def fence_closer(text: str) -> str:
+        """What closes a ``` fence left open at the end of `text` ("" if none is)."""
+        return "\n```" if text.count("```") % 2 == 1 else ""
+
+    def _flush(self, cursor: bool, now: float):
+        body = self.text
+        if cursor:
+            # Close an open fence temporarily so Markdown renders correctly,
+            # then show the cursor on a new line outside the block.
+            body += "\n```\n\n" + self.CURSOR if self.in_code_block else self.CURSOR
+        self.placeholder.markdown(body)
+        self.frames += 1
+        self.bytes_sent += len(body.encode("utf-8"))
+        self._pending = 0
+        self._last_flush = now
+
+    def tick(self, keepalive: float = 1.0):
+        """Redraw pending text once the frame interval has passed, or the last
+        frame again after `keepalive` quiet seconds (a script only notices a
+        pending rerun when it draws something)."""
+        now = time.monotonic()
+        if (self._pending and now - self._last_flush >= self.interval) or now - self._last_flush >= keepalive:
+            self._flush(cursor=True, now=now)
+
+    def finish(self) -> str:
+        """Draw the final frame (no cursor) and return the full reply."""
+        self._flush(cursor=False, now=time.monotonic())
+        log.info("render: %d frames, %d bytes for %d chars", self.frames, self.bytes_sent, len(self.text))
+        return self.text
+
+    def stats(self) -> dict:
+        return {"frames": self.frames, "bytes": self.bytes_sent, "chars": len(self.text)}
 
 
 # ─────────────────────────────────────────────────
-# Ollama helpers
+# Conversation store (SQLite)
 # ─────────────────────────────────────────────────
 
-def get_ollama_models() -> list[str]:
-    """Return list of locally installed Ollama model names."""
-    try:
-        import ollama
-        result = ollama.list()
-        # SDK returns an object with .models list
-        models = result.models if hasattr(result, "models") else result.get("models", [])
-        names = []
-        for m in models:
-            if hasattr(m, "model"):
-                names.append(m.model)
-            elif isinstance(m, dict):
-                names.append(m.get("model") or m.get("name", "unknown"))
-        return names if names else ["(nenhum modelo encontrado)"]
-    except Exception:
-        return []
+class ConversationStore:
+    """Persistent conversations in SQLite (WAL), keyed by the anonymous session id.
+
+    Reads go through one connection per thread. Writes are queued and applied by
+    a single writer thread, which drains everything pending into one
+    transaction, so bursts of appends from many sessions cost one commit. A read
+    waits only for the queued writes of its own conversation or owner, never
+    for other sessions' backlog.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id         TEXT PRIMARY KEY,
+        anon_id    TEXT NOT NULL,
+        title      TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS conversations_by_activity ON conversations (anon_id, updated_at);
+    CREATE TABLE IF NOT EXISTS messages (
+        id         INTEGER PRIMARY KEY AUTOINCREMENT,
+        conv_id    TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+        role       TEXT NOT NULL,
+        content    TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS messages_by_conv ON messages (conv_id, id);
+    """
+
+    # Full-text index over message bodies, kept in sync by triggers (cascaded deletes included)
+    FTS_SCHEMA = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END;
+    """
+
+    def __init__(self, path: str, batch_size: int = 500):
+        self.path = path
+        self.batch_size = batch_size
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._local = threading.local()
+        self._queue: queue.Queue = queue.Queue()
+        # Writes are numbered; _pending holds, per conversation id and per owner,
+        # the number of its last queued write, until the writer commits past it
+        self._seq_cond = threading.Condition()
+        self._seq = self._committed = 0
+        self._pending: dict[str, int] = {}
+        self._owners: dict[str, str] = {}   # conv_id -> anon_id, for conversations seen here
+        self._conn.executescript(self.SCHEMA)
+        self.fts = self._create_fts()
+        threading.Thread(target=self._writer, name="gurugpt-db-writer", daemon=True).start()
+
+    def _create_fts(self) -> bool:
+        """Create the FTS5 index (backfilling existing messages); False if SQLite lacks FTS5."""
+        conn = self._conn
+        existed = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone()
+        try:
+            conn.executescript(self.FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            log.warning("SQLite without FTS5, history search falls back to LIKE: %s", e)
+            return False
+        if not existed:
+            with conn:
+                conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        return True
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _writer(self):
+        conn = self._connect()
+        while True:
+            ops = [self._queue.get()]
+            while len(ops) < self.batch_size:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with conn:
+                    for _, sql, params in ops:
+                        conn.execute(sql, params)
+            except sqlite3.Error:
+                # Don't let one bad write roll back the rest of the batch
+                for _, sql, params in ops:
+                    try:
+                        with conn:
+                            conn.execute(sql, params)
+                    except sqlite3.Error as e:
+                        log.error("conversation store write failed: %s", e)
+            finally:
+                with self._seq_cond:
+                    self._committed = ops[-1][0]
+                    self._pending = {k: seq for k, seq in self._pending.items() if seq > self._committed}
+                    self._seq_cond.notify_all()
+                for _ in ops:
+                    self._queue.task_done()
+
+    def _write(self, sql: str, params: tuple, *scopes: str | None):
+        """Queue a write; reads of any of `scopes` (conversation ids, owners) wait for it."""
+        with self._seq_cond:
+            self._seq += 1
+            for scope in scopes:
+                if scope is not None:
+                    self._pending[scope] = self._seq
+            # Enqueued under the lock so the queue stays in sequence order
+            self._queue.put((self._seq, sql, params))
+
+    def _wait(self, scope: str):
+        """Block until the queued writes of `scope` have been committed."""
+        with self._seq_cond:
+            target = self._pending.get(scope, 0)
+            while self._committed < target:
+                self._seq_cond.wait()
+
+    def flush(self):
+        """Block until every queued write has been committed."""
+        self._queue.join()
+
+    # ── Reads ──
+    def list_conversations(self, anon_id: str) -> list[dict]:
+        """Titles only, least recently active first — message bodies are loaded by load_messages when opened."""
+        self._wait(anon_id)
+        rows = self._conn.execute(
+            "SELECT id, title FROM conversations WHERE anon_id = ? ORDER BY updated_at",
+            (anon_id,),
+        ).fetchall()
+        with self._seq_cond:
+            self._owners.update((cid, anon_id) for cid, _ in rows)
+        return [{"id": cid, "title": title} for cid, title in rows]
+
+    def load_messages(self, conv_id: str) -> list[dict]:
+        self._wait(conv_id)
+        rows = self._conn.execute(
+            "SELECT role, content FROM messages WHERE conv_id = ? ORDER BY id", (conv_id,)
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def search(self, anon_id: str, query: str, limit: int = 10) -> list[dict]:
+        """Conversations whose messages match every word of `query` (prefix match, accent-insensitive),
+        best first, each with a snippet of its best-matching message."""
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        self._wait(anon_id)
+        if self.fts:
+            match = " ".join(f'"{w}"*' for w in words)
+            # Oversample messages so `limit` distinct conversations usually survive the dedupe
+            rows = self._conn.execute(
+                "SELECT m.conv_id, c.title, snippet(messages_fts, 0, '**', '**', '…', 12) "
+                "FROM messages_fts "
+                "JOIN messages m ON m.id = messages_fts.rowid "
+                "JOIN conversations c ON c.id = m.conv_id "
+                "WHERE messages_fts MATCH ? AND c.anon_id = ? "
+                "ORDER BY bm25(messages_fts) LIMIT ?",
+                (match, anon_id, limit * 5),
+            ).fetchall()
+        else:
+            # Most recent first; only the first word narrows in SQL, the rest in Python
+            like = "%" + re.sub(r"([\\%_])", r"\\\1", words[0]) + "%"
+            candidates = self._conn.execute(
+                "SELECT m.conv_id, c.title, m.content FROM messages m "
+                "JOIN conversations c ON c.id = m.conv_id "
+                "WHERE c.anon_id = ? AND m.content LIKE ? ESCAPE '\\' ORDER BY m.id DESC LIMIT ?",
+                (anon_id, like, limit * 50),
+            ).fetchall()
+            lowered = [w.lower() for w in words]
+            rows = [
+                (cid, title, _snippet(content, words[0]))
+                for cid, title, content in candidates
+                if all(w in content.lower() for w in lowered)
+            ]
+        results: dict[str, dict] = {}
+        for cid, title, snippet in rows:
+            if cid not in results:
+                results[cid] = {"id": cid, "title": title, "snippet": " ".join(snippet.split())}
+                if len(results) == limit:
+                    break
+        return list(results.values())
+
+    # ── Writes (queued) ──
+    def create_conversation(self, conv_id: str, anon_id: str, title: str):
+        now = time.time()
+        with self._seq_cond:
+            self._owners[conv_id] = anon_id
+        self._write(
+            "INSERT OR IGNORE INTO conversations (id, anon_id, title, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (conv_id, anon_id, title, now, now),
+            conv_id, anon_id,
+        )
 
+    def rename_conversation(self, conv_id: str, title: str):
+        self._write("UPDATE conversations SET title = ? WHERE id = ?", (title, conv_id),
+                    conv_id, self._owners.get(conv_id))
+
+    def append_message(self, conv_id: str, role: str, content: str):
+        now = time.time()
+        owner = self._owners.get(conv_id)
+        self._write(
+            "INSERT INTO messages (conv_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+            (conv_id, role, content, now),
+            conv_id, owner,
+        )
+        self._write("UPDATE conversations SET updated_at = ? WHERE id = ?", (now, conv_id), conv_id, owner)
+
+    def delete_conversation(self, conv_id: str):
+        with self._seq_cond:
+            owner = self._owners.pop(conv_id, None)
+        self._write("DELETE FROM conversations WHERE id = ?", (conv_id,), conv_id, owner)
+
+
+def _snippet(text: str, word: str, width: int = 80) -> str:
+    """A window of `text` around the first occurrence of `word`, with the match in bold."""
+    at = text.lower().find(word.lower())
+    if at < 0:
+        return text[:width]
+    start = max(at - width // 2, 0)
+    head = "…" if start else ""
+    tail = "…" if at + len(word) + width // 2 < len(text) else ""
+    return (
+        f"{head}{text[start:at]}**{text[at:at + len(word)]}**"
+        f"{text[at + len(word):at + len(word) + width // 2]}{tail}"
+    )
 
-def stream_ollama_response(model: str, messages: list[dict]):
-    """Generator that yields text chunks from Ollama streaming chat."""
-    try:
-        import ollama
-        stream = ollama.chat(model=model, messages=messages, stream=True)
-        for chunk in stream:
-            delta = chunk.message.content if hasattr(chunk, "message") else ""
-            if delta:
-                yield delta
-    except Exception as e:
-        yield f"\n\n⚠️ Erro ao comunicar com Ollama: {e}"
+
+@st.cache_resource(show_spinner=False)
+def _conversation_store() -> ConversationStore:
+    return ConversationStore(DB_PATH)
 
 
 # ─────────────────────────────────────────────────
-# PDF helper
+# Background generation
 # ─────────────────────────────────────────────────
 
-def extract_pdf_text(file_bytes: bytes) -> str:
-    """Extract all text from a PDF given its raw bytes."""
-    try:
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        pages = [doc[i].get_text() for i in range(len(doc))]
-        doc.close()
-        return "\n\n".join(pages).strip()
-    except Exception as e:
-        return f"[Erro ao ler PDF: {e}]"
+# Appended to a reply cut short by the stop button (shown and stored with it)
+STOPPED_NOTE = "\n\n*⏹️ Resposta interrompida.*"
+
+
+class GenerationJob:
+    """One reply being generated for a conversation, owned by no session.
+
+    The worker appends chunks to `chunks`; readers keep their own offset, so
+    any run can attach at any time, replay what was already produced and then
+    follow the rest.
+    """
+
+    def __init__(self, conv_id: str, anon_id: str, model: str, api_messages: list[dict],
+                 options: dict | None = None, cache_key: str | None = None, report: dict | None = None):
+        self.conv_id, self.anon_id, self.model = conv_id, anon_id, model
+        self.api_messages, self.options, self.cache_key = api_messages, options, cache_key
+        self.report = report or {}
+        self.chunks: list[str] = []
+        self.ticket = None        # scheduler ticket (None for cache replays)
+        self.submitted = time.monotonic()
+        self.started = False      # a worker thread has picked it up
+        self.stats: dict = {}     # counters of Ollama's final chunk
+        self.ttft = None
+        self.queued = 0.0
+        self.cached = False
+        self.done = False
+        self.finished_at = 0.0
+        self.dropped = False      # conversation deleted: the reply is not stored
+        self.stop = threading.Event()   # set by the stop button
+        self.cancelled = False    # the reply was cut short by `stop`
+        self._cond = threading.Condition()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def append(self, chunk: str):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def read(self, offset: int, timeout: float) -> tuple[list[str], bool]:
+        """Chunks from `offset` on (waiting up to `timeout` for some) and whether the reply is complete."""
+        with self._cond:
+            if offset >= len(self.chunks) and not self.done:
+                self._cond.wait(timeout)
+            return self.chunks[offset:], self.done
+
+
+class GenerationWorkers:
+    """Process-wide thread pool that generates replies outside the script run.
+
+    A rerun (a click, switching conversation, a closed tab) stops the script,
+    not the job: the worker keeps streaming into the job's buffer, then stores
+    the reply and records its metrics, so whichever run opens the conversation
+    next resumes the display where it was. One job per conversation; jobs of
+    different conversations run side by side, admitted by the scheduler.
+    """
+
+    def __init__(self, store: ConversationStore, scheduler: GenerationScheduler,
+                 response_cache: ResponseCache, workers: int = GENERATION_WORKERS,
+                 keep: float = GENERATION_KEEP):
+        self.store, self.scheduler, self.response_cache = store, scheduler, response_cache
+        self.keep = keep
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gurugpt-gen")
+        self._lock = threading.Lock()
+        self._jobs: dict[str, GenerationJob] = {}
+
+    def get(self, conv_id: str) -> GenerationJob | None:
+        with self._lock:
+            return self._jobs.get(conv_id)
+
+    def submit(self, job: GenerationJob) -> GenerationJob:
+        with self._lock:
+            # Finished replies nobody came back for are in the store already
+            now = time.monotonic()
+            for cid in [c for c, j in self._jobs.items() if j.done and now - j.finished_at > self.keep]:
+                del self._jobs[cid]
+            self._jobs[job.conv_id] = job
+        cached = self.response_cache.get(job.cache_key) if job.cache_key else None
+        if cached is not None:
+            # Cache hit: no Ollama call, no scheduler slot
+            self._pool.submit(self._replay, job, cached)
+        else:
+            # A pool thread is only taken once the slot is granted, so the
+            # scheduler's fair queue decides who runs next, not the pool's FIFO
+            job.ticket = self.scheduler.enqueue(
+                job.model, job.anon_id, lambda ticket: self._pool.submit(self._run, job, ticket)
+            )
+        return job
+
+    def position(self, job: GenerationJob) -> int | None:
+        """`job`'s place in the scheduler's line, 0 once granted (None for cache replays)."""
+        return self.scheduler.position(job.ticket) if job.ticket is not None else None
+
+    def forget(self, job: GenerationJob):
+        """Unregister a finished job once its reply has been delivered."""
+        with self._lock:
+            if self._jobs.get(job.conv_id) is job:
+                del self._jobs[job.conv_id]
+
+    def cancel(self, conv_id: str):
+        """Stop the reply of `conv_id`; what was generated so far is stored."""
+        job = self.get(conv_id)
+        if job is not None and not job.done:
+            self._stop(job)
+
+    def drop(self, conv_id: str):
+        """The conversation is being deleted: stop its job without storing the reply."""
+        with self._lock:
+            job = self._jobs.pop(conv_id, None)
+        if job is not None:
+            job.dropped = True
+            if not job.done:
+                self._stop(job)
+
+    def _stop(self, job: GenerationJob):
+        job.stop.set()
+        if job.ticket is not None and self.scheduler.withdraw(job.ticket):
+            # Still in line: Ollama never saw it and no worker will pick it up
+            self._finish(job)
+
+    def _replay(self, job: GenerationJob, cached: str):
+        job.started = True
+        job.cached = True
+        for chunk in replay_cached(cached):
+            job.append(chunk)
+        job.ttft = time.monotonic() - job.submitted
+        self._finish(job)
+
+    def _run(self, job: GenerationJob, ticket):
+        job.started = True
+        job.queued = time.monotonic() - job.submitted
+        try:
+            if not job.stop.is_set():
+                # Leaving this block closes the HTTP stream and frees the host
+                with closing(stream_ollama_response(
+                    job.model, job.api_messages, job.options, job.stats, job.stop
+                )) as stream:
+                    for chunk in stream:
+                        if job.stop.is_set():
+                            break
+                        if job.ttft is None:
+                            job.ttft = time.monotonic() - job.submitted
+                        job.append(chunk)
+        except Exception as e:
+            log.exception("generation for conversation %s failed", job.conv_id)
+            job.append(f"\n\n⚠️ Erro ao gerar a resposta: {e}")
+        finally:
+            # Hands the slot to the next in line
+            self.scheduler.release(ticket)
+        self._finish(job)
+
+    def _finish(self, job: GenerationJob):
+        """Store the reply, record its metrics and wake the readers."""
+        # A stop that lands after the final chunk changes nothing
+        job.cancelled = job.stop.is_set() and not job.cached and job.stats.get("eval_count") is None
+        streamed = len(job.chunks)   # Ollama streams about one token per chunk
+        if job.cancelled:
+            # Outside any code block the reply was cut in, so the note renders as text
+            job.append(StreamRenderer.fence_closer(job.text) + STOPPED_NOTE)
+        try:
+            text = job.text
+            # Only complete generations are cached (errors never reach the final chunk)
+            if job.cache_key and not job.cached and job.stats.get("eval_count") is not None:
+                self.response_cache.put(job.cache_key, text)
+            if not job.dropped:
+                self.store.append_message(job.conv_id, "assistant", text)
+            record_generation(job.model, job.stats, job.ttft, job.queued, text, job.cached, job.cancelled)
+            if not job.cached:
+                record_context(job.model, job.report)
+            if job.cancelled:
+                record_cancel(job.model, streamed)
+        finally:
+            job.finish()
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            running = sum(not j.done for j in self._jobs.values())
+            return {"running": running, "finished": len(self._jobs) - running}
+
+
+@st.cache_resource(show_spinner=False)
+def _generation_workers() -> GenerationWorkers:
+    return GenerationWorkers(_conversation_store(), _scheduler(), _response_cache())
+
+
+def follow_generation(job: GenerationJob, placeholder, workers: GenerationWorkers) -> StreamRenderer:
+    """Draw `job`'s reply into `placeholder`: what exists at once, then the rest as it streams.
+
+    Returns when the reply is complete. A rerun that stops this only stops the
+    display; the worker carries on.
+    """
+    renderer = StreamRenderer(placeholder)
+    offset, shown, drawn = 0, None, 0.0
+    while True:
+        chunks, done = job.read(offset, timeout=renderer.interval or 0.1)
+        offset += len(chunks)
+        for chunk in chunks:
+            renderer.feed(chunk)
+        if done:
+            renderer.finish()
+            return renderer
+        if offset:
+            renderer.tick()
+            continue
+        # Nothing generated yet. Redrawn at least every second: a script only
+        # notices a pending rerun when it draws something.
+        position = workers.position(job)
+        if position:
+            status = f"⏳ Servidor ocupado — você é o **{position}º** da fila…"
+        else:
+            # Granted but no worker thread free yet, or already waiting for the first token
+            status = "" if job.started else "⏳ Na fila…"
+        now = time.monotonic()
+        if status != shown or now - drawn >= 1.0:
+            if status:
+                placeholder.markdown(status)
+            else:
+                placeholder.empty()
+            shown, drawn = status, now
 
 
 # ─────────────────────────────────────────────────
@@ -783,193 +2421,287 @@ def extract_pdf_text(file_bytes: bytes) -> str:
 
 def init_state():
     if "anon_id" not in st.session_state:
-        st.session_state.anon_id = str(uuid.uuid4())[:8]
-
-    # conversations: dict[conv_id] -> {"title": str, "messages": list[dict]}
+        # The id lives in a cookie, so a reload finds the same history while
+        # links carry none of it (headless runs have no real cookie jar)
+        anon_id = st.context.cookies.get(SESSION_COOKIE, "")
+        if not isinstance(anon_id, str) or not re.fullmatch(r"[0-9a-f]{32}", anon_id):
+            anon_id = uuid.uuid4().hex
+        st.session_state.anon_id = anon_id
+
+    # conversations: dict[conv_id] -> {"title": str, "messages": list[dict] | None, "saved": bool}
+    # messages is None until the conversation is opened (hydrated from the store).
+    # Kept in order of last activity, most recent last.
     if "conversations" not in st.session_state:
-        st.session_state.conversations = {}
+        st.session_state.conversations = {
+            c["id"]: {"title": c["title"], "messages": None, "saved": True}
+            for c in _conversation_store().list_conversations(st.session_state.anon_id)
+        }
 
     # active conversation id
     if "active_conv" not in st.session_state:
-        _new_conv()
+        if st.session_state.conversations:
+            st.session_state.active_conv = next(reversed(st.session_state.conversations))
+        else:
+            _new_conv()
+
+    # documents attached to each conversation, indexed under one memory budget
+    if "corpus" not in st.session_state:
+        st.session_state.corpus = DocumentCorpus(int(CORPUS_MB * 1024 * 1024), _text_cache())
+    # uploader file ids already processed, so a removed document stays removed
+    if "doc_uploads" not in st.session_state:
+        st.session_state.doc_uploads = set()
+
+    # page of the sidebar history being shown (0 = most recent)
+    if "history_page" not in st.session_state:
+        st.session_state.history_page = 0
 
-    # pending PDF context
-    if "pdf_context" not in st.session_state:
-        st.session_state.pdf_context = None
-    if "pdf_name" not in st.session_state:
-        st.session_state.pdf_name = None
+    # how many of the active conversation's most recent messages are rendered
+    if "transcript_window" not in st.session_state:
+        st.session_state.transcript_window = TRANSCRIPT_WINDOW
 
 
 def _new_conv() -> str:
     cid = str(uuid.uuid4())
+    # Not written to the store until its first message, so empty chats don't pile up
     st.session_state.conversations[cid] = {
         "title": "Nova conversa",
         "messages": [],
+        "saved": False,
     }
-    st.session_state.active_conv = cid
-    st.session_state.pdf_context = None
-    st.session_state.pdf_name = None
+    st.session_state.history_page = 0
+    _open_conv(cid)
     return cid
 
 
+def _open_conv(cid: str):
+    """Make `cid` active, releasing the previous conversation's messages from memory."""
+    prev = st.session_state.get("active_conv")
+    if prev != cid and prev in st.session_state.conversations:
+        if st.session_state.conversations[prev]["saved"]:
+            st.session_state.conversations[prev]["messages"] = None
+    st.session_state.active_conv = cid
+    st.session_state.transcript_window = TRANSCRIPT_WINDOW
+
+
+def _remove_document(digest: str):
+    st.session_state.corpus.remove(st.session_state.active_conv, digest)
+
+
 def current_messages() -> list[dict]:
-    return st.session_state.conversations[st.session_state.active_conv]["messages"]
+    conv = st.session_state.conversations[st.session_state.active_conv]
+    if conv["messages"] is None:
+        conv["messages"] = _conversation_store().load_messages(st.session_state.active_conv)
+    return conv["messages"]
+
+
+def current_model() -> str | None:
+    """The model picked in the sidebar, if the catalog still offers it."""
+    model = st.session_state.get("selected_model")
+    return model if model in get_ollama_models() else None
+
+
+def _append_message(role: str, content: str):
+    """Append to the active conversation, in session state and in the store."""
+    cid = st.session_state.active_conv
+    convs = st.session_state.conversations
+    conv = convs[cid]
+    if next(reversed(convs)) != cid:
+        # Most recent activity goes last, i.e. to the top of the sidebar
+        convs[cid] = convs.pop(cid)
+        st.session_state.history_page = 0
+    store = _conversation_store()
+    if not conv["saved"]:
+        store.create_conversation(cid, st.session_state.anon_id, conv["title"])
+        conv["saved"] = True
+    current_messages().append({"role": role, "content": content})
+    store.append_message(cid, role, content)
+
+
+def _show_history_page(page: int):
+    st.session_state.history_page = page
+
+
+def _show_earlier_messages():
+    st.session_state.transcript_window += TRANSCRIPT_WINDOW
+
+
+def _delete_conv(cid: str):
+    conv = st.session_state.conversations.pop(cid)
+    st.session_state.corpus.drop(cid)
+    _generation_workers().drop(cid)
+    if conv["saved"]:
+        _conversation_store().delete_conversation(cid)
+
+
+def _forget_history():
+    """Delete every conversation of this browser and start over under a new anonymous id."""
+    for cid in list(st.session_state.conversations):
+        _delete_conv(cid)
+    st.session_state.anon_id = uuid.uuid4().hex
+    _new_conv()
 
 
 # ─────────────────────────────────────────────────
 # Sidebar
 # ─────────────────────────────────────────────────
 
-def render_sidebar(models: list[str]) -> str | None:
-    """Renders the sidebar and returns the selected model."""
-    with st.sidebar:
-        # Brand mini
-        st.markdown(
-            """
-            <div style="text-align:center;margin-bottom:1rem;">
-                <span style="font-family:'Outfit',sans-serif;font-size:1.3rem;font-weight:900;
-                background:linear-gradient(135deg,#c4b5fd,#7c3aed);
-                -webkit-background-clip:text;-webkit-text-fill-color:transparent;
-                background-clip:text;">&#129368; GuruGPT</span>
-            </div>
-            """,
-            unsafe_allow_html=True,
-        )
+@st.fragment
+def render_sidebar():
+    """Renders the sidebar contents (call inside `with st.sidebar`).
+
+    A fragment: paging, searching and picking a model rerun only the sidebar;
+    actions that change the open conversation rerun the whole app.
+    """
+    models = get_ollama_models()
+    # Brand mini
+    st.markdown(
+        """
+        <div style="text-align:center;margin-bottom:1rem;">
+            <span style="font-family:'Outfit',sans-serif;font-size:1.3rem;font-weight:900;
+            background:linear-gradient(135deg,#c4b5fd,#7c3aed);
+            -webkit-background-clip:text;-webkit-text-fill-color:transparent;
+            background-clip:text;">&#129368; GuruGPT</span>
+        </div>
+        """,
+        unsafe_allow_html=True,
+    )
+
+    # New chat button
+    if st.button("\u2795\u2009 Nova Conversa", key="new_chat_btn", use_container_width=True):
+        _new_conv()
+        st.rerun()
 
-        # Styles for conversation rows (title + X as one visual unit)
+    st.markdown("<hr class='g-divider'>", unsafe_allow_html=True)
+
+    # Conversation history
+    st.markdown("<div class='sidebar-title'>Hist\u00f3rico</div>", unsafe_allow_html=True)
+    if st.session_state.pop("clear_history_search", False):
+        # A widget's value can only be reset before it is drawn in the run
+        st.session_state.history_search = ""
+    query = st.text_input(
+        "Buscar",
+        key="history_search",
+        placeholder="\U0001f50e Buscar nas conversas",
+        label_visibility="collapsed",
+    ).strip()
+
+    convs = st.session_state.conversations
+    active = st.session_state.active_conv
+    workers = _generation_workers()
+    # Only the visible page gets widgets, so cost doesn't grow with the history
+    pages = max(1, -(-len(convs) // HISTORY_PAGE_SIZE))
+    page = min(st.session_state.history_page, pages - 1)
+    start = page * HISTORY_PAGE_SIZE
+    visible = list(islice(reversed(convs.items()), start, start + HISTORY_PAGE_SIZE))
+
+    if query:
+        results = [
+            r for r in _conversation_store().search(st.session_state.anon_id, query)
+            if r["id"] in convs
+        ]
+        if not results:
+            st.caption("Nada encontrado.")
+        for r in results:
+            if st.button(
+                f"\U0001f50e {r['title']}",
+                key=f"found_{r['id']}",
+                help=r["title"],
+                use_container_width=True,
+            ):
+                _open_conv(r["id"])
+                st.session_state.clear_history_search = True
+                st.rerun()
+            st.caption(r["snippet"])
+    elif not convs:
         st.markdown(
-            """
-            <style>
-            /* Nova Conversa centralizado */
-            [data-testid="stSidebar"] [data-testid="stBaseButton-secondary"]:first-of-type {
-                text-align: center !important;
-                justify-content: center !important;
-            }
-            /* Conversation rows: force single-line flex layout on mobile */
-            .conv-row [data-testid="stHorizontalBlock"] {
-                gap: 0 !important;
-                margin-bottom: 5px !important;
-                flex-wrap: nowrap !important;
-                align-items: stretch !important;
-            }
-            .conv-row [data-testid="stColumn"] {
-                min-width: 0 !important;
-                flex-shrink: 1 !important;
-            }
-            .conv-row [data-testid="stColumn"]:last-child {
-                flex: 0 0 auto !important;
-                width: auto !important;
-            }
-            /* Title button: left side pill */
-            .conv-row [data-testid="column"]:first-child button,
-            .conv-row [data-testid="stColumn"]:first-child button {
-                border-radius: 10px 0 0 10px !important;
-                text-align: left !important;
-                border-right: 1px solid rgba(124,58,237,0.2) !important;
-            }
-            /* X button: right side pill */
-            .conv-row [data-testid="column"]:last-child button,
-            .conv-row [data-testid="stColumn"]:last-child button {
-                border-radius: 0 10px 10px 0 !important;
-                background: transparent !important;
-                color: #6b6a8a !important;
-                font-weight: 500 !important;
-                font-size: 0.65rem !important;
-                letter-spacing: 0 !important;
-                box-shadow: none !important;
-                padding: 0 6px !important;
-                height: 100% !important;
-                min-height: 0 !important;
-                line-height: 1.2 !important;
-                white-space: nowrap !important;
-                overflow: hidden !important;
-            }
-            .conv-row [data-testid="column"]:last-child button:hover,
-            .conv-row [data-testid="stColumn"]:last-child button:hover {
-                background: rgba(239,68,68,0.18) !important;
-                color: #ef4444 !important;
-                transform: none !important;
-            }
-            </style>
-            """,
+            "<p style='color:#a89fd0;font-size:0.8rem;text-align:center;'>Nenhuma conversa ainda.</p>",
             unsafe_allow_html=True,
         )
+    else:
+        for cid, conv in visible:
+            is_active = cid == active
+            title = conv["title"]
+            job = workers.get(cid)
+            if job is not None and not job.done:
+                icon = "\u23f3"  # reply still being generated in the background
+            else:
+                icon = "\U0001f4ac" if is_active else "\U0001f5e8\ufe0f"
 
-        # New chat button
-        if st.button("\u2795\u2009 Nova Conversa", key="new_chat_btn", use_container_width=True):
-            _new_conv()
-            st.rerun()
-
-        st.markdown("<hr class='g-divider'>", unsafe_allow_html=True)
-
-        # Conversation history
-        st.markdown("<div class='sidebar-title'>Hist\u00f3rico</div>", unsafe_allow_html=True)
+            st.markdown("<div class='conv-row'>", unsafe_allow_html=True)
+            col_t, col_x = st.columns([8, 1])
+
+            with col_t:
+                if st.button(
+                    f"{icon} {title}",
+                    key=f"conv_{cid}",
+                    help=title,
+                    use_container_width=True,
+                ):
+                    _open_conv(cid)
+                    st.rerun()
+
+            with col_x:
+                if st.button("×", key=f"del_{cid}", help="Apagar conversa", use_container_width=True):
+                    _delete_conv(cid)
+                    if cid == active:
+                        if st.session_state.conversations:
+                            _open_conv(next(reversed(st.session_state.conversations)))
+                        else:
+                            _new_conv()
+                    st.rerun()
+
+            st.markdown("</div>", unsafe_allow_html=True)
+
+        if pages > 1:
+            col_prev, col_pos, col_next = st.columns([1, 2, 1])
+            with col_prev:
+                st.button("\u2039", key="history_prev", disabled=page == 0, use_container_width=True,
+                          on_click=_show_history_page, args=(page - 1,))
+            col_pos.caption(f"{start + 1}\u2013{start + len(visible)} de {len(convs)}")
+            with col_next:
+                st.button("\u203a", key="history_next", disabled=page == pages - 1,
+                          use_container_width=True, on_click=_show_history_page, args=(page + 1,))
 
-        convs = st.session_state.conversations
-        active = st.session_state.active_conv
+    st.markdown("<hr class='g-divider'>", unsafe_allow_html=True)
 
-        if not convs:
-            st.markdown(
-                "<p style='color:#a89fd0;font-size:0.8rem;text-align:center;'>Nenhuma conversa ainda.</p>",
-                unsafe_allow_html=True,
-            )
-        else:
-            for cid, conv in list(convs.items()):
-                is_active = cid == active
-                title = conv["title"]
-                icon = "\U0001f4ac" if is_active else "\U0001f5e8\ufe0f"
+    # Session info
+    st.markdown(
+        f"<p style='font-size:0.72rem;color:#6b6a8a;text-align:center;'>Sess\u00e3o an\u00f4nima \u00b7 {st.session_state.anon_id[:8]}</p>",
+        unsafe_allow_html=True,
+    )
+    with st.popover("\U0001f511 Apagar hist\u00f3rico", use_container_width=True):
+        st.caption("Apaga todas as conversas deste navegador e troca o ID an\u00f4nimo que as identifica.")
+        if st.button("Apagar tudo", key="forget_history", type="primary", use_container_width=True):
+            _forget_history()
+            st.rerun()
 
-                st.markdown("<div class='conv-row'>", unsafe_allow_html=True)
-                col_t, col_x = st.columns([8, 1])
-
-                with col_t:
-                    if st.button(
-                        f"{icon} {title}",
-                        key=f"conv_{cid}",
-                        help=title,
-                        use_container_width=True,
-                    ):
-                        st.session_state.active_conv = cid
-                        st.session_state.pdf_context = None
-                        st.session_state.pdf_name = None
-                        st.rerun()
-
-                with col_x:
-                    if st.button("×", key=f"del_{cid}", help="Apagar conversa", use_container_width=True):
-                        del st.session_state.conversations[cid]
-                        if cid == active:
-                            if st.session_state.conversations:
-                                st.session_state.active_conv = list(
-                                    st.session_state.conversations.keys()
-                                )[-1]
-                            else:
-                                _new_conv()
-                        st.rerun()
-
-                st.markdown("</div>", unsafe_allow_html=True)
-
-        st.markdown("<hr class='g-divider'>", unsafe_allow_html=True)
-
-        # Session info
-        st.markdown(
-            f"<p style='font-size:0.72rem;color:#6b6a8a;text-align:center;'>Sess\u00e3o an\u00f4nima \u00b7 {st.session_state.anon_id}</p>",
-            unsafe_allow_html=True,
+    # Model selector inside sidebar
+    st.markdown("<div class='sidebar-title' style='margin-top:0.5rem;'>Modelo de IA</div>", unsafe_allow_html=True)
+    if models:
+        st.selectbox(
+            label="modelo",
+            options=models,
+            label_visibility="collapsed",
+            key="selected_model",
         )
+    else:
+        st.warning("Ollama n\u00e3o encontrado ou sem modelos instalados.")
 
-        # Model selector inside sidebar
-        st.markdown("<div class='sidebar-title' style='margin-top:0.5rem;'>Modelo de IA</div>", unsafe_allow_html=True)
-        if models:
-            selected_model = st.selectbox(
-                label="modelo",
-                options=models,
-                label_visibility="collapsed",
-                key="selected_model",
-            )
-        else:
-            st.warning("Ollama n\u00e3o encontrado ou sem modelos instalados.")
-            selected_model = None
+    if RESPONSE_CACHE:
+        cache = _response_cache().stats()
+        st.caption(
+            f"Cache de respostas: {cache['hits']} acertos · {cache['misses']} falhas "
+            f"({cache['hit_rate']:.0%})"
+        )
 
-        return selected_model
+    info = _ollama_pool().info(current_model())
+    if info:
+        parts = [info["family"], info["parameter_size"], info["quantization"]]
+        if info["size"]:
+            parts.append(_human_size(info["size"]))
+        if len(OLLAMA_HOSTS) > 1:
+            parts.append(f"{info['hosts']}/{len(OLLAMA_HOSTS)} servidores")
+        st.caption(" \u00b7 ".join(p for p in parts if p))
 
 
 # ─────────────────────────────────────────────────
@@ -1014,170 +2746,340 @@ def render_logo(models: list[str]):
     st.markdown("<hr class='g-divider'>", unsafe_allow_html=True)
 
 
-def render_pdf_uploader():
-    """Renders the PDF uploader and processes any uploaded file."""
-    with st.expander("📄 Anexar PDF para análise", expanded=bool(st.session_state.pdf_name)):
-        uploaded = st.file_uploader(
-            "Selecione um arquivo PDF",
-            type=["pdf"],
-            key="pdf_uploader",
+def ingest_document(file_bytes: bytes, digest: str, kind: str, name: str, progress) -> BM25Index:
+    """Stream a document page by page into a BM25 index, updating a progress bar.
+
+    Pages come from the shared text cache (or fresh extraction written through
+    to it); each one is chunked and indexed before the next is read, so no full
+    page list or joined document string is ever built.
+    """
+    index, shown = BM25Index(), -1
+    for page_no, n_pages, text in _text_cache().iter_pages(file_bytes, digest, kind):
+        for chunk in chunk_page(page_no, text):
+            index.add(chunk)
+        # Redraw only on whole-percent steps: one delta per page would flood the websocket
+        pct = int(100 * page_no / n_pages) if n_pages else 0
+        if pct != shown:
+            shown = pct
+            progress.progress(pct / 100, text=f"{name}: página {page_no:,} de {n_pages:,}…")
+    progress.empty()
+    return index
+
+
+def _page_label(doc: CorpusDocument, chunk: dict) -> str:
+    return f"{'p.' if doc.kind == 'pdf' else 'parte'} {chunk['page']}"
+
+
+@st.fragment
+def render_document_uploader():
+    """Renders the document uploader and the active conversation's corpus.
+
+    A fragment: adding or removing documents reruns only this area; the chat
+    searches the corpus from session state when the next prompt is sent. Each
+    upload is indexed once, as it arrives, without touching the rest.
+    """
+    cid = st.session_state.active_conv
+    corpus = st.session_state.corpus
+    with st.expander("📄 Anexar documentos para análise", expanded=bool(corpus.documents(cid))):
+        uploads = st.file_uploader(
+            "Selecione arquivos PDF, TXT, Markdown ou DOCX",
+            type=list(DOCUMENT_KINDS),
+            accept_multiple_files=True,
+            key=f"doc_uploader_{cid}",
             label_visibility="collapsed",
         )
-        if uploaded is not None:
-            if uploaded.name != st.session_state.pdf_name:
-                with st.spinner("Extraindo texto do PDF..."):
-                    text = extract_pdf_text(uploaded.read())
-                st.session_state.pdf_context = text
-                st.session_state.pdf_name = uploaded.name
-                st.success(f"✅ PDF carregado: **{uploaded.name}** — {len(text):,} caracteres extraídos.")
-
-        if st.session_state.pdf_name:
-            st.markdown(
-                f"<div class='pdf-badge'>📎 {st.session_state.pdf_name}</div>",
+        for uploaded in uploads or ():
+            # Each upload is read once; later reruns skip it even while it is still listed
+            upload_id = getattr(uploaded, "file_id", None) or f"{cid}/{uploaded.name}/{uploaded.size}"
+            if upload_id in st.session_state.doc_uploads:
+                continue
+            st.session_state.doc_uploads.add(upload_id)
+            data = uploaded.getvalue()
+            # Keyed on content, not name: a file already seen by any session comes
+            # straight from the text cache
+            digest = hashlib.sha256(data).hexdigest()
+            if corpus.has(cid, digest):
+                continue
+            kind = document_kind(uploaded.name)
+            try:
+                index = ingest_document(
+                    data, digest, kind, uploaded.name,
+                    st.progress(0.0, text=f"Extraindo texto de {uploaded.name}..."),
+                )
+            except Exception as e:
+                st.error(f"[Erro ao ler {uploaded.name}: {e}]")
+                continue
+            with st.spinner("Gerando embeddings para busca semântica..."):
+                vectors = embed_chunks(index.chunks)
+            corpus.add(cid, CorpusDocument(uploaded.name, digest, kind, index, vectors))
+            st.success(
+                f"✅ Documento carregado: **{uploaded.name}** — {index.chars:,} caracteres "
+                f"extraídos em {len(index.chunks):,} trechos."
+            )
+
+        docs = corpus.documents(cid)
+        for doc in docs:
+            col_name, col_remove = st.columns([0.85, 0.15], vertical_alignment="center")
+            col_name.markdown(
+                f"<div class='pdf-badge'>📎 {html.escape(doc.name)}</div>",
                 unsafe_allow_html=True,
             )
-            if st.button("❌ Remover PDF", key="remove_pdf"):
-                st.session_state.pdf_context = None
-                st.session_state.pdf_name = None
-                st.rerun()
+            # Callback, so the uploader's own rerun already shows the document gone
+            col_remove.button("❌", key=f"remove_doc_{doc.digest}", help="Remover documento",
+                              on_click=_remove_document, args=(doc.digest,))
+        if docs:
+            st.caption(
+                f"{len(docs)} documento(s), {sum(d.chars for d in docs):,} caracteres · "
+                f"em memória nesta sessão: {corpus.hot_chars / 1048576:.1f} de {CORPUS_MB:g} MB"
+            )
 
 
-def render_chat(selected_model: str | None):
-    """Renders chat history and handles user input."""
-    messages = current_messages()
+# Static on purpose: identical bytes every turn keep Ollama's prompt-prefix cache warm
+SYSTEM_PROMPT = (
+    "Você é o GuruGPT, um assistente de IA sábio, claro e útil. "
+    "Responda sempre de forma organizada e em português, salvo quando o usuário escrever em outro idioma.\n\n"
+    "Regras de formatação obrigatórias:\n"
+    "- Sempre que incluir código-fonte (em qualquer linguagem), envolva-o em um bloco Markdown com o identificador da linguagem. "
+    "Exemplo: use ```python ... ``` para Python, ```javascript ... ``` para JavaScript, ```java ... ``` para Java, etc.\n"
+    "- Nunca exiba código como texto simples ou dentro de parágrafos.\n"
+    "- Use títulos (##), listas e negrito (**texto**) para organizar explicações longas.\n"
+    "- Quando a mensagem do usuário trouxer trechos de documentos anexados, use-os como contexto e cite o documento e a página."
+)
+
+
+def _stop_generation(cid: str):
+    _generation_workers().cancel(cid)
 
-    # Display existing messages
-    for msg in messages:
+
+def _attach_reply(job: GenerationJob):
+    """Add a finished background reply to the session's copy of its conversation.
+
+    The worker has already stored it; a copy loaded from the store since then
+    has it too.
+    """
+    conv = st.session_state.conversations.get(job.conv_id)
+    if conv is not None and conv["messages"] and conv["messages"][-1]["role"] == "user":
+        conv["messages"].append({"role": "assistant", "content": job.text})
+
+
+@st.fragment
+def render_chat():
+    """Renders chat history and handles user input.
+
+    A fragment: sending a message reruns only the chat area, unless the sidebar
+    has to show a new title or order. Replies are generated by GenerationWorkers;
+    this only submits them and follows their stream buffer, so a rerun mid-reply
+    picks the display up again instead of losing the generation.
+    """
+    selected_model = current_model()
+    messages = current_messages()
+    cid = st.session_state.active_conv
+    workers = _generation_workers()
+    job = workers.get(cid)
+    if job is not None and job.done:
+        # Finished while nobody was watching: it simply becomes history
+        _attach_reply(job)
+        workers.forget(job)
+        job = None
+    generating = job is not None
+
+    # Display the most recent messages; older ones only on request, so a rerun
+    # costs the same however long the conversation has grown
+    hidden = max(len(messages) - st.session_state.transcript_window, 0)
+    if hidden:
+        st.button(
+            f"⬆️ Carregar mensagens anteriores ({hidden})",
+            key="transcript_earlier",
+            use_container_width=True,
+            on_click=_show_earlier_messages,
+        )
+    for msg in islice(messages, hidden, None):
         with st.chat_message(msg["role"], avatar="🧑" if msg["role"] == "user" else "🧘"):
             st.markdown(msg["content"])
 
     # Input
-    placeholder = (
-        "Digite sua mensagem…" if selected_model else "⚠️ Selecione um modelo para começar"
-    )
-    prompt = st.chat_input(placeholder, disabled=(not selected_model))
-
-    if prompt and selected_model:
-        # Build context-aware messages list
-        api_messages = []
-
-        # System prompt enriched with PDF context if present
-        system_content = (
-            "Você é o GuruGPT, um assistente de IA sábio, claro e útil. "
-            "Responda sempre de forma organizada e em português, salvo quando o usuário escrever em outro idioma.\n\n"
-            "Regras de formatação obrigatórias:\n"
-            "- Sempre que incluir código-fonte (em qualquer linguagem), envolva-o em um bloco Markdown com o identificador da linguagem. "
-            "Exemplo: use ```python ... ``` para Python, ```javascript ... ``` para JavaScript, ```java ... ``` para Java, etc.\n"
-            "- Nunca exiba código como texto simples ou dentro de parágrafos.\n"
-            "- Use títulos (##), listas e negrito (**texto**) para organizar explicações longas."
+    if generating:
+        placeholder = "⏳ Aguarde a resposta atual…"
+    else:
+        placeholder = "Digite sua mensagem…" if selected_model else "⚠️ Selecione um modelo para começar"
+    prompt = st.chat_input(placeholder, disabled=(not selected_model) or generating)
+
+    sidebar_stale = False
+    if prompt and generating:
+        # Sent from a box drawn before this reply started (e.g. another tab)
+        st.toast("Aguarde a resposta atual terminar antes de enviar outra mensagem.", icon="⏳")
+    elif prompt and selected_model:
+        # Document excerpts change every turn, so they travel with the prompt
+        # instead of the system message (keeps the cached prompt prefix intact)
+        context = ""
+        corpus = st.session_state.corpus
+        if corpus.documents(cid):
+            # Retrieve only the chunks relevant to this prompt (plus the previous
+            # question, so short follow-ups still hit the right pages), as many
+            # as the model's window has room for
+            prev_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+            head = "[Trechos dos documentos anexados relevantes para esta pergunta:]\n\n"
+            tail = "\n\n[Pergunta:]"
+            budget = context_budget(selected_model, SYSTEM_PROMPT, prompt) - len(head) - len(tail)
+            excerpts = select_context(corpus, cid, f"{prev_user}\n{prompt}", budget=budget) if budget > 0 else []
+            if excerpts:
+                context = (
+                    head
+                    + "\n\n".join(f"[{doc.name}, {_page_label(doc, c)}] {c['text']}" for doc, c in excerpts)
+                    + tail
+                )
+
+        # Build context-aware messages list, trimmed to the model's context window
+        conv = st.session_state.conversations[cid]
+        api_messages, options, context_report = build_api_messages(
+            selected_model, SYSTEM_PROMPT, messages, prompt, context, conv.get("context_floor", 0)
         )
-        if st.session_state.pdf_context:
-            system_content += (
-                f"\n\nO usuário anexou o seguinte documento PDF ({st.session_state.pdf_name}) "
-                "para contexto:\n\n"
-                + st.session_state.pdf_context[:12000]  # cap at ~12k chars to stay within context
-                + ("\n\n[... documento truncado para caber no contexto ...]"
-                   if len(st.session_state.pdf_context) > 12000 else "")
-            )
-
-        api_messages.append({"role": "system", "content": system_content})
-        api_messages.extend(messages)
-        api_messages.append({"role": "user", "content": prompt})
+        conv["context_floor"] = context_report["floor"]
 
         # Display user message immediately
         with st.chat_message("user", avatar="🧑"):
             st.markdown(prompt)
 
-        # Store in history
-        conv = st.session_state.conversations[st.session_state.active_conv]
-        conv["messages"].append({"role": "user", "content": prompt})
+        # The sidebar lists titles by recency: only a change there needs a full rerun
+        convs = st.session_state.conversations
+        sidebar_stale = conv["title"] == "Nova conversa" or next(reversed(convs)) != cid
 
         # Auto-title conversation from first user message
         if conv["title"] == "Nova conversa":
             conv["title"] = prompt[:42] + ("…" if len(prompt) > 42 else "")
-
-        # Stream assistant response
-        with st.chat_message("assistant", avatar="🧘"):
-            response_placeholder = st.empty()
-            full_response = ""
-            with st.spinner(""):
-                for chunk in stream_ollama_response(selected_model, api_messages):
-                    full_response += chunk
-                    # Count backtick-fence openings to detect if we're inside a code block.
-                    # An odd number of ``` in the response means a block is still open.
-                    open_fences = full_response.count("```") % 2 == 1
-                    if open_fences:
-                        # Close the fence temporarily so Markdown renders correctly,
-                        # then show the cursor on a new line outside the block.
-                        response_placeholder.markdown(full_response + "\n```\n\n▌")
-                    else:
-                        response_placeholder.markdown(full_response + "▌")
-            response_placeholder.markdown(full_response)
-
-        conv["messages"].append({"role": "assistant", "content": full_response})
+            if conv["saved"]:
+                _conversation_store().rename_conversation(cid, conv["title"])
+
+        # Store in history (the worker stores the reply)
+        _append_message("user", prompt)
+
+        cache_key = None
+        if RESPONSE_CACHE:
+            cache_key = response_cache_key(selected_model, api_messages, prompt, corpus.key(cid))
+        job = workers.submit(GenerationJob(
+            cid, st.session_state.anon_id, selected_model, api_messages, options, cache_key, context_report
+        ))
+
+    if job is None:
+        return
+
+    # Stream assistant response (from the start of the buffer, if reattaching)
+    with st.chat_message("assistant", avatar="🧘"):
+        placeholder = st.empty()
+        stop = st.empty()
+        if not job.stop.is_set():
+            stop.button("⏹️ Parar", key="stop_generation", help="Interromper a resposta",
+                        on_click=_stop_generation, args=(cid,))
+        with st.spinner(""):
+            renderer = follow_generation(job, placeholder, workers)
+        stop.empty()
+    record_render(job.model, renderer.stats())
+
+    # Token accounting: our estimate next to what Ollama actually evaluated.
+    # prompt_eval_count excludes prompt tokens served from Ollama's prefix cache,
+    # so a low count / short prefill against a long prompt means the cache hit.
+    context_report = dict(job.report)
+    context_report["prompt_tokens"] = job.stats.get("prompt_eval_count")
+    context_report["reply_tokens"] = job.stats.get("eval_count")
+    context_report["prefill_ms"] = (job.stats.get("prompt_eval_duration") or 0) / 1e6
+    context_report["ttft_ms"] = (job.ttft or 0) * 1000
+    context_report["queue_ms"] = job.queued * 1000
+    context_report["cached"] = job.cached
+    log.info("context: %s", context_report)
+
+    _attach_reply(job)
+    workers.forget(job)
+    if sidebar_stale:
         st.rerun()
+    elif generating:
+        # The input box was drawn disabled while this reply was running
+        try:
+            st.rerun(scope="fragment")
+        except StreamlitAPIException:
+            # Part of a full app run, where a fragment can't rerun on its own
+            st.rerun()
 
 
 # ─────────────────────────────────────────────────
 # Entry point
 # ─────────────────────────────────────────────────
 
-def main():
-    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
-    # ☰ button: STATIC HTML — always in DOM, no JS needed to create it
-    st.markdown(MOBILE_BTN_HTML, unsafe_allow_html=True)
-    # JS via iframe (components.v1.html guarantees script execution):
-    # accesses window.parent.document, moves button out of React tree,
-    # attaches addEventListener safely outside React's managed DOM.
-    components.html(TOGGLE_COMPONENT_HTML, height=0)
-
-    # Force sidebar always open: clear Streamlit's cached collapsed state
-    st.markdown("""
-    <script>
-    (function() {
-        // Clear any stored sidebar-collapsed state
-        try {
-            Object.keys(localStorage).forEach(function(k) {
-                if (k.toLowerCase().includes('sidebar') || k.toLowerCase().includes('collapsed')) {
-                    localStorage.removeItem(k);
-                }
-            });
-        } catch(e) {}
-
-        // If sidebar appears closed, click the expand control
-        function forceOpen() {
-            var sidebar = document.querySelector('[data-testid="stSidebar"]');
-            if (!sidebar) return;
-            var w = sidebar.getBoundingClientRect().width;
-            if (w < 60) {
-                var btn = document.querySelector('[data-testid="collapsedControl"] button')
-                       || document.querySelector('[data-testid="collapsedControl"]');
-                if (btn) btn.click();
-            }
-        }
+def _static_served(ext: str) -> bool:
+    """Whether browsers will accept app/static/*<ext> (e.g. ".css") under its real type."""
+    if not st.get_option("server.enableStaticServing"):
+        return False
+    try:
+        # Older servers send unlisted file types as text/plain + nosniff, which
+        # browsers refuse as a stylesheet or script
+        from streamlit.web.server.app_static_file_handler import SAFE_APP_STATIC_FILE_EXTENSIONS
+    except ImportError:
+        return True
+    return ext in SAFE_APP_STATIC_FILE_EXTENSIONS
+
+
+def _static_file(name: str) -> tuple[bytes, str]:
+    """File contents plus a short content hash for cache-busting URLs."""
+    with open(os.path.join(STATIC_DIR, name), "rb") as f:
+        data = f.read()
+    return data, hashlib.sha256(data).hexdigest()[:12]
+
+
+@st.cache_resource(show_spinner=False)
+def theme_css_tag() -> str:
+    """A <link> to the stylesheet, versioned by content hash so it can be cached forever.
+
+    Falls back to inlining the file where static serving can't deliver CSS.
+    """
+    data, version = _static_file(THEME_CSS)
+    if _static_served(".css"):
+        return f'<link rel="stylesheet" href="app/static/{THEME_CSS}?v={version}">'
+    log.warning("static serving unavailable for CSS, inlining %s on every full rerun", THEME_CSS)
+    return f"<style>{data.decode('utf-8')}</style>"
+
+
+@st.cache_resource(show_spinner=False)
+def toggle_loader_html() -> str:
+    """The sidebar-toggle loader, pointing at the versioned static script (or inlining it)."""
+    data, version = _static_file(THEME_JS)
+    if _static_served(".js"):
+        source = f"s.src = {json.dumps(f'app/static/{THEME_JS}?v={version}')};"
+    else:
+        # "</" would end the loader's own <script> element
+        source = f"s.textContent = {json.dumps(data.decode('utf-8'))};".replace("</", "<\\/")
+    return TOGGLE_LOADER_HTML % {"version": json.dumps(version), "source": source}
+
 
-        // Try immediately and after short delays
-        forceOpen();
-        setTimeout(forceOpen, 200);
-        setTimeout(forceOpen, 600);
-        setTimeout(forceOpen, 1200);
-    })();
-    </script>
-    """, unsafe_allow_html=True)
+def session_cookie_html(anon_id: str) -> str:
+    """The loader that stores `anon_id` in the history cookie."""
+    cookie = f"{SESSION_COOKIE}={anon_id}; path=/; max-age={SESSION_COOKIE_DAYS * 86400}; SameSite=Strict"
+    return SESSION_COOKIE_HTML % {"cookie": json.dumps(cookie)}
+
+
+def main():
+    st.markdown(theme_css_tag(), unsafe_allow_html=True)
+    # Sidebar toggle controller (☰ drawer on mobile, reopen button on desktop)
+    components.html(toggle_loader_html(), height=0)
 
     init_state()
+    # The browser sent no cookie, or one for an id this session has since replaced
+    if st.context.cookies.get(SESSION_COOKIE) != st.session_state.anon_id:
+        components.html(session_cookie_html(st.session_state.anon_id), height=0)
+    _start_metrics_exporters()
 
-    # Fetch models once per run (fast, local call)
+    # Shared catalog snapshot — refreshed in the background, no network I/O here
     models = get_ollama_models()
 
-    # ── Sidebar ──
-    selected_model = render_sidebar(models)
+    # Everything above and below the fragments is only re-sent on full reruns;
+    # interactions inside a fragment rerun just that fragment.
+    # ── Sidebar ── (st.sidebar can't be entered from inside a fragment)
+    with st.sidebar:
+        render_sidebar()
 
     # ── Main ──
     render_logo(models)
-    render_pdf_uploader()
+    render_document_uploader()
     st.markdown("<div style='height:0.5rem'></div>", unsafe_allow_html=True)
-    render_chat(selected_model)
+    render_chat()
 
     # ── Footer ──
     st.markdown(
@@ -0,0 +1,197 @@
+"""
+Benchmark: concurrent chat sessions against a fake Ollama server.
+
+    python benchmarks/chat_load.py --sessions 1,2,4,8,16 --turns 3 --tps 40
+
+Each session is a headless Streamlit run of app.py (streamlit.testing AppTest)
+driven from its own thread, so main() and render_chat() execute exactly as for a
+browser tab, sharing this process's cache_resource state (Ollama client,
+scheduler, catalog, store) like real sessions do. The fake server runs as a
+subprocess so its CPU is not charged to the app.
+
+Per concurrency level it reports p50/p95/p99 of:
+  send  - rerun that submits a prompt and streams the whole reply
+  idle  - plain rerun of an existing conversation (sidebar, history, widgets)
+  ttft  - prompt submitted → first token leaving the fake server
+plus app CPU (cores busy over the level's wall time) and RSS at the end.
+"""
+
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url: str, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def rss_mb() -> float:
+    """Current resident set size; falls back to the peak where /proc is missing."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = q / 100 * (len(ordered) - 1)
+    lo = int(rank)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (rank - lo)
+
+
+def allow_concurrent_apptests():
+    """Make AppTest behave like one server process with many sessions.
+
+    AppTest installs a mock Runtime singleton per run and clears it afterwards,
+    which breaks overlapping runs from other threads, so the last one stays
+    visible. It also compiles the script into a fresh ScriptCache per run; the
+    server shares one (compiling once, under its lock), and so do we.
+    """
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    shared_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: shared_cache
+
+    pinned = []
+
+    def instance(cls):
+        if cls._instance is not None:
+            pinned[:] = [cls._instance]
+            return cls._instance
+        if pinned:
+            return pinned[0]
+        raise RuntimeError("Runtime hasn't been created!")
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or bool(pinned))
+
+
+def run_session(AppTest, level: int, session: int, turns: int, timeout: float, out: dict, errors: list):
+    try:
+        at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=timeout)
+        at.run()
+        for turn in range(turns):
+            prompt = f"bench c{level} s{session} t{turn}: explique o conceito número {turn}."
+            t0 = time.time()
+            at.chat_input[0].set_value(prompt).run()
+            out["send"].append(time.time() - t0)
+            out["sent"].append((prompt, t0))
+
+            t0 = time.time()
+            at.run()
+            out["idle"].append(time.time() - t0)
+            if at.exception:
+                raise RuntimeError(at.exception[0].value)
+    except Exception as e:  # noqa: BLE001 - reported in the summary line
+        errors.append(f"session {session}: {e}")
+
+
+def run_level(AppTest, level: int, turns: int, timeout: float, fake_url: str) -> dict:
+    out = {"send": [], "idle": [], "sent": []}
+    errors: list[str] = []
+    threads = [
+        threading.Thread(target=run_session, args=(AppTest, level, i, turns, timeout, out, errors))
+        for i in range(level)
+    ]
+    cpu0, wall0 = cpu_seconds(), time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - wall0
+    cpu = cpu_seconds() - cpu0
+
+    with urllib.request.urlopen(f"{fake_url}/bench/first-token", timeout=5) as resp:
+        first_token = json.load(resp)
+    ttft = [first_token[p] - t0 for p, t0 in out["sent"] if p in first_token]
+    return {"send": out["send"], "idle": out["idle"], "ttft": ttft,
+            "cpu": cpu / wall if wall else 0.0, "rss": rss_mb(), "errors": errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", default="1,2,4,8,16", help="comma-separated concurrency levels")
+    parser.add_argument("--turns", type=int, default=3, help="prompts per session")
+    parser.add_argument("--tps", type=float, default=40.0, help="fake server tokens/sec per stream")
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--prefill-ms", type=float, default=50.0)
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds per script run")
+    args = parser.parse_args()
+
+    port = free_port()
+    fake_url = f"http://127.0.0.1:{port}"
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "fake_ollama.py"), "--port", str(port),
+        "--tps", str(args.tps), "--reply-tokens", str(args.reply_tokens),
+        "--prefill-ms", str(args.prefill_ms),
+    ], stdout=subprocess.DEVNULL)
+    try:
+        wait_ready(f"{fake_url}/api/version")
+        scratch = tempfile.mkdtemp(prefix="gurugpt-bench-")
+        # Must be set before the first AppTest run imports the script's config
+        os.environ["OLLAMA_HOST"] = fake_url
+        os.environ["GURUGPT_DB_PATH"] = os.path.join(scratch, "bench.db")
+        os.environ["GURUGPT_CACHE_DIR"] = scratch
+        os.environ.setdefault("GURUGPT_RESPONSE_CACHE", "0")
+        os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+
+        from streamlit.testing.v1 import AppTest
+        allow_concurrent_apptests()
+
+        print(f"{'sessions':>8}  {'send p50/p95/p99 (s)':>22}  {'idle p50/p95/p99 (ms)':>22}  "
+              f"{'ttft p50/p95/p99 (ms)':>22}  {'cpu':>5}  {'rss MB':>7}")
+        for level in (int(n) for n in args.sessions.split(",")):
+            r = run_level(AppTest, level, args.turns, args.timeout, fake_url)
+            send = "/".join(f"{percentile(r['send'], q):.2f}" for q in (50, 95, 99))
+            idle = "/".join(f"{percentile(r['idle'], q) * 1000:.0f}" for q in (50, 95, 99))
+            ttft = "/".join(f"{percentile(r['ttft'], q) * 1000:.0f}" for q in (50, 95, 99))
+            print(f"{level:>8}  {send:>22}  {idle:>22}  {ttft:>22}  {r['cpu']:>5.2f}  {r['rss']:>7.1f}")
+            for err in r["errors"]:
+                print(f"          ! {err}")
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Fake Ollama server for benchmarks: streams canned tokens at a configurable rate.
+
+    python benchmarks/fake_ollama.py --port 11435 --tps 40 --reply-tokens 200
+
+Implements the endpoints GuruGPT uses (/api/tags, /api/chat, /api/show,
+/api/embed, /api/version). GET /bench/first-token returns, per user prompt,
+the wall-clock time its first token was sent, so a client can compute exact
+time-to-first-token.
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "O GuruGPT responde com calma e clareza . Aqui está um exemplo de código :\n"
+    "```python\nprint('olá')\n```\n e mais uma explicação detalhada sobre o assunto ."
+).split(" ")
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Set on the subclass built by serve()
+    models: list[str] = []
+    tps: float = 40.0
+    reply_tokens: int = 200
+    prefill_ms: float = 50.0
+    context_length: int = 8192
+    first_token: dict[str, float] = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, obj, status: int = 200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, obj):
+        line = (json.dumps(obj) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._json({"models": [
+                {
+                    "name": name, "model": name, "size": 4_700_000_000, "digest": "0" * 64,
+                    "modified_at": "2024-01-01T00:00:00Z",
+                    "details": {"format": "gguf", "family": "fake", "parameter_size": "8B",
+                                "quantization_level": "Q4_K_M"},
+                }
+                for name in self.models
+            ]})
+        elif self.path == "/api/version":
+            self._json({"version": "0.0.0-fake"})
+        elif self.path == "/bench/first-token":
+            with self.lock:
+                self._json(dict(self.first_token))
+        else:
+            self._json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if self.path == "/api/chat":
+            self._chat(body)
+        elif self.path == "/api/show":
+            self._json({"model_info": {"general.architecture": "fake",
+                                       "fake.context_length": self.context_length}})
+        elif self.path == "/api/embed":
+            inputs = body.get("input") or []
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self._json({"model": body.get("model"), "embeddings": [
+                [float((hash(w) % 97) / 97) for w in (t.split() + ["_"] * 8)[:8]] for t in inputs
+            ]})
+        else:
+            self._json({"error": "not found"}, 404)
+
+    def _chat(self, body: dict):
+        model = body.get("model", "")
+        prompt = next((m["content"] for m in reversed(body.get("messages", [])) if m["role"] == "user"), "")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        started = time.perf_counter()
+        time.sleep(self.prefill_ms / 1000)
+        prefill = time.perf_counter() - started
+        delay = 1.0 / self.tps if self.tps > 0 else 0.0
+        try:
+            for i in range(self.reply_tokens):
+                self._chunk({"model": model, "created_at": "2024-01-01T00:00:00Z",
+                             "message": {"role": "assistant", "content": WORDS[i % len(WORDS)] + " "},
+                             "done": False})
+                if i == 0:
+                    with self.lock:
+                        self.first_token[prompt] = time.time()
+                time.sleep(delay)
+            total = time.perf_counter() - started
+            self._chunk({
+                "model": model, "created_at": "2024-01-01T00:00:00Z",
+                "message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "stop",
+                "total_duration": int(total * 1e9), "load_duration": 0,
+                "prompt_eval_count": sum(len(m.get("content", "")) // 4 for m in body.get("messages", [])),
+                "prompt_eval_duration": int(prefill * 1e9),
+                "eval_count": self.reply_tokens, "eval_duration": int((total - prefill) * 1e9),
+            })
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client stopped reading (e.g. cancelled generation)
+
+
+def serve(port: int, models: list[str], tps: float, reply_tokens: int, prefill_ms: float,
+          host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    handler = type("Handler", (FakeOllamaHandler,), {
+        "models": models, "tps": tps, "reply_tokens": reply_tokens,
+        "prefill_ms": prefill_ms, "first_token": {}, "lock": threading.Lock(),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--models", default="fake-llm:8b", help="comma-separated model names")
+    parser.add_argument("--tps", type=float, default=40.0, help="tokens per second per stream")
+    parser.add_argument("--reply-tokens", type=int, default=200)
+    parser.add_argument("--prefill-ms", type=float, default=50.0)
+    args = parser.parse_args()
+    server = serve(args.port, args.models.split(","), args.tps, args.reply_tokens, args.prefill_ms, args.host)
+    print(f"fake ollama on http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
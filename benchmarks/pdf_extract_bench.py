@@ -0,0 +1,78 @@
+"""
+Benchmark: PDF text extraction throughput (pages/sec) vs. worker count.
+
+    python benchmarks/pdf_extract_bench.py --pages 1000
+    python benchmarks/pdf_extract_bench.py --pdf manual.pdf --repeat 5
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz  # PyMuPDF
+
+import pdf_extract
+
+LOREM = (
+    "GuruGPT benchmark page {n}. Lorem ipsum dolor sit amet, consectetur adipiscing "
+    "elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. "
+)
+
+
+def synthetic_pdf(n_pages: int, lines: int = 40) -> bytes:
+    """A text-heavy PDF with `n_pages` pages."""
+    doc = fitz.open()
+    for n in range(n_pages):
+        page = doc.new_page()
+        text = "\n".join(LOREM.format(n=n) for _ in range(lines))
+        page.insert_textbox(fitz.Rect(36, 36, 576, 806), text, fontsize=7)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def bench(data: bytes, workers: int, repeat: int) -> tuple[float, int]:
+    """Best wall time over `repeat` runs, and the page count."""
+    best, n_pages = float("inf"), 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        # min_pages=0 forces the pool even for small inputs; workers=1 is the serial path
+        pages = pdf_extract.extract_pages(data, workers=workers, min_pages=0)
+        best = min(best, time.perf_counter() - t0)
+        n_pages = len(pages)
+    return best, n_pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", help="PDF file to extract (default: synthetic document)")
+    parser.add_argument("--pages", type=int, default=1000, help="pages in the synthetic document")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per worker count (best is kept)")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            data = f.read()
+    else:
+        data = synthetic_pdf(args.pages)
+
+    counts, w = [], 1
+    while w < args.max_workers:
+        counts.append(w)
+        w *= 2
+    counts.append(args.max_workers)
+
+    serial = None
+    print(f"{'workers':>7}  {'seconds':>8}  {'pages/s':>9}  {'speedup':>7}")
+    for workers in counts:
+        secs, n_pages = bench(data, workers, args.repeat)
+        serial = serial or secs
+        print(f"{workers:>7}  {secs:>8.3f}  {n_pages / secs:>9.1f}  {serial / secs:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
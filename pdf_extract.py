@@ -0,0 +1,130 @@
+"""
+GuruGPT — page-parallel PDF text extraction.
+Kept out of app.py so pool workers can import it without running the Streamlit script.
+"""
+
+import os
+import tempfile
+import threading
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+
+# Below this many pages the pool start-up costs more than it saves
+PARALLEL_MIN_PAGES = 48
+
+# One process pool at a time per server: further large uploads arriving
+# meanwhile are read serially instead of starting cpu_count more processes
+_pool_slot = threading.BoundedSemaphore(1)
+
+# ─────────────────────────────────────────────────
+# Worker side — one open document per process
+# ─────────────────────────────────────────────────
+
+_worker_doc = None
+
+
+def _init_worker(path: str):
+    """Open the shared document once per worker process."""
+    global _worker_doc
+    _worker_doc = fitz.open(path, filetype="pdf")
+
+
+def _extract_range(bounds: tuple[int, int]) -> list[str]:
+    start, stop = bounds
+    return [_worker_doc[i].get_text() for i in range(start, stop)]
+
+
+# ─────────────────────────────────────────────────
+# Caller side
+# ─────────────────────────────────────────────────
+
+def page_ranges(n_pages: int, workers: int) -> list[tuple[int, int]]:
+    """Contiguous [start, stop) ranges, ~4 per worker so slow pages don't stall one process."""
+    if n_pages <= 0:
+        return []
+    step = max(1, -(-n_pages // (workers * 4)))
+    return [(start, min(start + step, n_pages)) for start in range(0, n_pages, step)]
+
+
+def _mp_context():
+    # Never plain fork: the Streamlit server is multi-threaded by the time a PDF
+    # arrives, and a forked child can inherit a lock some other thread held.
+    # Workers are forked from a fresh single-threaded server that has already
+    # imported __main__ and this module (with PyMuPDF), so they still start fast.
+    if "forkserver" in mp.get_all_start_methods():
+        ctx = mp.get_context("forkserver")
+        ctx.set_forkserver_preload(["__main__", __name__])
+        return ctx
+    return mp.get_context("spawn")
+
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+
+def iter_pages(file_bytes: bytes, workers: int | None = None,
+               min_pages: int = PARALLEL_MIN_PAGES):
+    """Yield (page number, page count, text) for every page, in document order.
+
+    Small documents (or workers <= 1) are read serially in this process; larger
+    ones are split into page ranges across a process pool whose workers each
+    open the same temporary copy of the file (only its path crosses the process
+    boundary, and the OS page cache shares its pages). Only one pool runs per process: while
+    it is busy, other documents are read serially too. Only the ranges in
+    flight are held in memory, never the whole document's text.
+    """
+    workers = workers or default_workers()
+    doc = fitz.open(stream=file_bytes, filetype="pdf")
+    try:
+        n_pages = len(doc)
+        if workers <= 1 or n_pages < min_pages or not _pool_slot.acquire(blocking=False):
+            for i in range(n_pages):
+                yield i + 1, n_pages, doc[i].get_text()
+            return
+    finally:
+        doc.close()
+
+    try:
+        yield from _iter_pages_parallel(file_bytes, n_pages, workers)
+    finally:
+        _pool_slot.release()
+
+
+def _iter_pages_parallel(file_bytes: bytes, n_pages: int, workers: int):
+    ranges = deque(page_ranges(n_pages, workers))
+    workers = min(workers, len(ranges))
+    fd, path = tempfile.mkstemp(prefix="gurugpt-", suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(file_bytes)
+        yield from _run_pool(path, ranges, n_pages, workers)
+    finally:
+        os.remove(path)
+
+
+def _run_pool(path: str, ranges: deque, n_pages: int, workers: int):
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=_mp_context(),
+        initializer=_init_worker,
+        initargs=(path,),
+    ) as pool:
+        # Bounded window of ranges in flight, consumed in submission order:
+        # page order is preserved and a slow consumer can't pile up results.
+        in_flight = deque()
+        while ranges or in_flight:
+            while ranges and len(in_flight) < workers * 2:
+                bounds = ranges.popleft()
+                in_flight.append((bounds[0], pool.submit(_extract_range, bounds)))
+            start, future = in_flight.popleft()
+            for offset, text in enumerate(future.result()):
+                yield start + offset + 1, n_pages, text
+
+
+def extract_pages(file_bytes: bytes, workers: int | None = None,
+                  min_pages: int = PARALLEL_MIN_PAGES) -> list[str]:
+    """Text of every page, extracted in parallel for large documents."""
+    return [text for _, _, text in iter_pages(file_bytes, workers, min_pages)]
@@ -0,0 +1,180 @@
+/*
+ * GuruGPT sidebar toggle — one controller per page.
+ *
+ * Installed into the main Streamlit document by the loader iframe in app.py
+ * (toggle_loader_html). Reruns may remount that iframe any number of times;
+ * the loader finds window.__ggToggle and only calls sync(), so listeners,
+ * observers and elements exist once per page, not once per rerun.
+ *
+ *   - mobile ☰ button + backdrop: created here, outside React's tree
+ *   - desktop reopen button: shown while the sidebar is collapsed, tracked by a
+ *     ResizeObserver on the sidebar and a matchMedia listener (no polling);
+ *     its glow is a CSS animation (static/gurugpt.css)
+ *   - destroy(): removes every listener, observer, timer and element
+ */
+(function () {
+  'use strict';
+
+  var W = window;
+  var D = document;
+  var script = D.currentScript;
+  var version = (script && script.getAttribute('data-gg-toggle')) || '';
+
+  if (W.__ggToggle) {
+    if (W.__ggToggle.version === version) {
+      W.__ggToggle.sync();
+      return;
+    }
+    W.__ggToggle.destroy();   // newer app version: replace the old controller
+  }
+
+  var SIDEBAR = '[data-testid="stSidebar"]';
+  var EXPAND = [
+    '[data-testid="stExpandSidebarButton"]',
+    '[data-testid="collapsedControl"] button',
+    '[data-testid="stSidebarCollapseButton"] button'
+  ];
+  // Inline !important beats Streamlit's own sidebar rules while the drawer is open
+  var DRAWER = [
+    ['position', 'fixed'], ['top', '0'], ['left', '0'], ['width', '82vw'],
+    ['max-width', '320px'], ['height', '100dvh'], ['transform', 'translateX(0)'],
+    ['translate', 'none'], ['display', 'flex'], ['visibility', 'visible'],
+    ['opacity', '1'], ['z-index', '99999'], ['overflow-y', 'auto']
+  ];
+  // A collapsed sidebar keeps a sliver of width
+  var COLLAPSED_PX = 60;
+  // Bounded wait for the sidebar when sync() runs before React has drawn it
+  var RETRY_MS = 250;
+  var RETRY_MAX = 20;
+
+  var mobile = W.matchMedia('(max-width: 768px)');
+  var undo = [];          // side effects to revert in destroy(), in reverse order
+  var sidebar = null;
+  var retries = 0;
+  var retryTimer = 0;
+  var resizeObserver = new W.ResizeObserver(onSidebarResize);
+
+  function listen(target, type, fn, options) {
+    target.addEventListener(type, fn, options);
+    undo.push(function () { target.removeEventListener(type, fn, options); });
+  }
+
+  function mount(html) {
+    var holder = D.createElement('div');
+    holder.innerHTML = html;
+    var node = holder.firstChild;
+    D.body.appendChild(node);
+    undo.push(function () { node.remove(); });
+    return node;
+  }
+
+  // ── Mobile drawer ──
+  function isOpen() {
+    return !!sidebar && sidebar.classList.contains('mobile-open');
+  }
+
+  function open() {
+    if (!sidebar) return;
+    sidebar.classList.add('mobile-open');
+    DRAWER.forEach(function (p) { sidebar.style.setProperty(p[0], p[1], 'important'); });
+    D.body.classList.add('gg-sidebar-open');
+  }
+
+  function close() {
+    if (sidebar) {
+      sidebar.classList.remove('mobile-open');
+      DRAWER.forEach(function (p) { sidebar.style.removeProperty(p[0]); });
+    }
+    D.body.classList.remove('gg-sidebar-open');
+  }
+
+  function toggle() {
+    if (isOpen()) close(); else open();
+  }
+
+  // ── Desktop reopen button ──
+  function updateDesktop() {
+    var collapsed = !sidebar || sidebar.getBoundingClientRect().width <= COLLAPSED_PX;
+    desktopBtn.hidden = mobile.matches || !collapsed;
+  }
+
+  function expandSidebar() {
+    for (var i = 0; i < EXPAND.length; i++) {
+      var target = D.querySelector(EXPAND[i]);
+      if (target) {
+        target.click();
+        return;
+      }
+    }
+  }
+
+  // ── Sidebar tracking ──
+  function onSidebarResize() {
+    // React may replace the sidebar element; a detached one reports zero width
+    if (sidebar && !sidebar.isConnected) sync();
+    else updateDesktop();
+  }
+
+  function sync() {
+    var found = D.querySelector(SIDEBAR);
+    if (found !== sidebar) {
+      if (sidebar) resizeObserver.unobserve(sidebar);
+      sidebar = found;
+      if (sidebar) resizeObserver.observe(sidebar);
+    }
+    W.clearTimeout(retryTimer);
+    retryTimer = 0;
+    if (!sidebar && retries < RETRY_MAX) {
+      retries += 1;
+      retryTimer = W.setTimeout(sync, RETRY_MS);
+    } else if (sidebar) {
+      retries = 0;
+    }
+    updateDesktop();
+  }
+
+  function destroy() {
+    close();
+    W.clearTimeout(retryTimer);
+    resizeObserver.disconnect();
+    while (undo.length) undo.pop()();
+    sidebar = null;
+    if (W.__ggToggle === controller) delete W.__ggToggle;
+  }
+
+  // ── Build once ──
+  var mobileWrap = mount(
+    '<div id="gg-wrap-2"><button id="gg-btn-2" type="button" title="Abrir/fechar menu">' +
+    '<span class="gg-ham">&#9776;</span><span class="gg-x">&#10005;</span></button></div>'
+  );
+  var backdrop = mount('<div id="gg-bd"></div>');
+  var desktopBtn = mount(
+    '<button id="gurugpt-sidebar-open-btn" type="button" title="Abrir painel lateral" hidden>&#9776;</button>'
+  );
+
+  listen(mobileWrap.firstChild, 'click', toggle);
+  listen(backdrop, 'click', close);
+  listen(desktopBtn, 'click', expandSidebar);
+  listen(mobile, 'change', function () {
+    if (!mobile.matches) close();
+    updateDesktop();
+  });
+
+  // Swipe left closes the drawer
+  var touchX = 0;
+  listen(D, 'touchstart', function (e) { touchX = e.changedTouches[0].screenX; }, { passive: true });
+  listen(D, 'touchend', function (e) {
+    if (isOpen() && e.changedTouches[0].screenX - touchX < -60) close();
+  }, { passive: true });
+
+  var controller = {
+    version: version,
+    open: open,
+    close: close,
+    toggle: toggle,
+    sync: sync,
+    destroy: destroy
+  };
+  W.__ggToggle = controller;
+  sync();
+})();
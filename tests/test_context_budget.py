@@ -0,0 +1,76 @@
+import pytest
+
+import app
+from app import CONTEXT_REPLY_TOKENS, build_api_messages, context_budget, estimate_tokens
+
+
+@pytest.fixture
+def window(monkeypatch):
+    """Pretend every model has a `window.size`-token context."""
+    class Window:
+        size = 2048
+    monkeypatch.setattr(app, "model_context_length", lambda model: Window.size)
+    return Window
+
+
+def turns(n, chars=400):
+    history = []
+    for i in range(n):
+        history += [{"role": "user", "content": f"pergunta {i} " + "p" * chars},
+                    {"role": "assistant", "content": f"resposta {i} " + "r" * chars}]
+    return history
+
+
+def tokens(messages):
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages)
+
+
+def test_short_history_is_sent_whole(window):
+    history = turns(2)
+    messages, options, report = build_api_messages("m", "sys", history, "oi")
+    assert messages == [{"role": "system", "content": "sys"}, *history, {"role": "user", "content": "oi"}]
+    assert options == {"num_ctx": 2048}
+    assert report["history_dropped"] == 0 and report["floor"] == 0
+    assert report["prompt_tokens_est"] == tokens(messages)
+
+
+def test_overflowing_history_is_summarized_on_a_user_boundary(window):
+    history = turns(20)
+    messages, _, report = build_api_messages("m", "sys", history, "oi")
+    assert report["history_dropped"] > 0
+    assert report["floor"] % 2 == 0                       # history resumes on a user message
+    assert messages[1]["role"] == "system" and "omitidas" in messages[1]["content"]
+    assert messages[2] == history[report["floor"]]
+    assert report["prompt_tokens_est"] <= 2048 - CONTEXT_REPLY_TOKENS
+
+
+def test_floor_is_kept_until_the_history_overflows_again(window):
+    history = turns(20)
+    _, _, first = build_api_messages("m", "sys", history, "oi")
+    history += turns(1, chars=10)
+    messages, _, second = build_api_messages("m", "sys", history, "oi", floor=first["floor"])
+    assert second["floor"] == first["floor"]
+    assert messages[2] == history[first["floor"]]        # same prefix: Ollama's KV cache still applies
+
+
+def test_long_prompt_is_clipped_in_the_middle(window):
+    prompt = "início " + "x" * 20000 + " final"
+    messages, _, report = build_api_messages("m", "sys", [], prompt)
+    sent = messages[-1]["content"]
+    assert sent.startswith("início") and sent.endswith("final") and "omitidos" in sent
+    assert report["prompt_clipped"] == len(prompt) - len(sent)
+    assert report["prompt_tokens_est"] <= 2048 - CONTEXT_REPLY_TOKENS
+
+
+def test_context_goes_with_the_prompt_in_the_last_message(window):
+    messages, _, _ = build_api_messages("m", "sys", turns(1), "oi", context="[doc.pdf, p. 1] trecho")
+    assert messages[-1] == {"role": "user", "content": "[doc.pdf, p. 1] trecho\n\noi"}
+
+
+def test_context_budget_shrinks_with_the_window_and_the_prompt(window):
+    small = context_budget("m", "sys", "oi", cap=10**6)
+    assert 0 < small < (2048 - CONTEXT_REPLY_TOKENS) * app.CHARS_PER_TOKEN / 2
+    assert context_budget("m", "sys", "x" * 2000, cap=10**6) < small
+    assert context_budget("m", "sys", "x" * 20000, cap=10**6) == 0
+    window.size = 8192
+    assert context_budget("m", "sys", "oi", cap=6000) == 6000
@@ -0,0 +1,40 @@
+import hashlib
+
+import app
+from app import BM25Index, CorpusDocument, DocumentCorpus, DocumentTextCache, select_context
+
+
+def ingest(cache, corpus, cid, name, text):
+    data = text.encode()
+    digest = hashlib.sha256(data).hexdigest()
+    index = BM25Index(c for page_no, _, page in cache.iter_pages(data, digest, "text")
+                      for c in app.chunk_page(page_no, page))
+    return corpus.add(cid, CorpusDocument(name, digest, "text", index))
+
+
+def test_spilled_documents_are_read_only_when_the_query_needs_them(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "EMBED_MODEL", "")
+    cache = DocumentTextCache(str(tmp_path), 10**6, 10**6)
+    corpus = DocumentCorpus(40, cache)   # room for one document
+    docs = [ingest(cache, corpus, "c", f"{topic}.txt", f"Notas sobre {topic} e mais {topic}.")
+            for topic in ("clorofila", "quasar", "mitocondria")]
+    assert [d.index is not None for d in docs] == [False, False, True]
+
+    reads = []
+    monkeypatch.setattr(cache, "_cached", lambda key: None)
+    iter_pages = cache.iter_pages
+    monkeypatch.setattr(cache, "iter_pages", lambda *a, **kw: (reads.append(a[1]), iter_pages(*a, **kw))[1])
+
+    picked = select_context(corpus, "c", "quasar", top_k=2)
+    assert [d.name for d, _ in picked] == ["quasar.txt"]
+    assert reads == [docs[1].digest]                    # only the matching spilled document
+    assert [d.index is not None for d in docs] == [False, False, True]   # and it stays spilled
+    assert corpus.hot_chars == docs[2].chars
+
+
+def test_corpus_stats_match_the_indexes(tmp_path):
+    cache = DocumentTextCache(str(tmp_path), 10**6, 10**6)
+    corpus = DocumentCorpus(10**6, cache)
+    doc = ingest(cache, corpus, "c", "a.txt", "quasar quasar estrela\n\nestrela anã")
+    assert doc.df == {tok: len(p) for tok, p in doc.index.postings.items()}
+    assert doc.tokens == doc.index.total_len and doc.n_chunks == len(doc.index.chunks)
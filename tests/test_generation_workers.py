@@ -0,0 +1,36 @@
+from app import (STOPPED_NOTE, ConversationStore, GenerationJob, GenerationScheduler,
+                 GenerationWorkers, ResponseCache)
+
+
+def workers(tmp_path, limit=1):
+    store = ConversationStore(str(tmp_path / "t.db"))
+    return GenerationWorkers(store, GenerationScheduler(limit), ResponseCache(), workers=1)
+
+
+def job(conv_id):
+    return GenerationJob(conv_id, "a" * 32, "m", [{"role": "user", "content": "oi"}])
+
+
+def test_stopped_reply_closes_its_code_block_before_the_note(tmp_path):
+    w = workers(tmp_path)
+    w.store.create_conversation("c", "a" * 32, "c")
+    j = job("c")
+    j.append("Veja:\n```py\nx = 1")
+    j.stop.set()
+    w._finish(j)
+    assert j.cancelled
+    assert j.text == "Veja:\n```py\nx = 1\n```" + STOPPED_NOTE
+    w.store.flush()
+    assert w.store.load_messages("c")[-1]["content"] == j.text
+
+
+def test_cancel_then_drop_of_a_queued_job(tmp_path):
+    w = workers(tmp_path)
+    busy = w.scheduler.enqueue("m", "x", lambda ticket: None)
+    queued = w.submit(job("c"))
+    assert w.position(queued) == 1
+    w.cancel("c")
+    assert queued.done and queued.cancelled
+    w.drop("c")
+    assert w.scheduler.snapshot() == {"m": {"running": 1, "waiting": 0}}
+    w.scheduler.release(busy)
@@ -0,0 +1,101 @@
+import pytest
+
+import app
+from app import BM25Index, CorpusDocument, DocumentCorpus, EmbeddingStore, VectorIndex, select_context
+
+# Stub embeddings: one dimension per topic, so cosine similarity means "same topic"
+TOPICS = ("planta", "rede", "estrela")
+
+
+def stub_embed(texts):
+    return [[float(topic in text.lower()) + 0.01 for topic in TOPICS] for text in texts]
+
+
+@pytest.fixture
+def embeddings(monkeypatch):
+    """Semantic retrieval on, backed by a fresh store and the stub embedder."""
+    store = EmbeddingStore(max_docs=8)
+    monkeypatch.setattr(app, "EMBED_MODEL", "stub")
+    monkeypatch.setattr(app, "_embedding_store", lambda: store)
+    return store
+
+
+def chunks(*texts, page=1):
+    return [{"page": page, "text": t} for t in texts]
+
+
+def document(corpus, cid, name, *texts, vectors=True):
+    index = BM25Index(chunks(*texts))
+    doc = CorpusDocument(name, name, "text", index, app.embed_chunks(index.chunks, stub_embed) if vectors else None)
+    return corpus.add(cid, doc)
+
+
+def test_bm25_ranks_the_matching_chunk_first():
+    index = BM25Index(chunks("A fotossíntese ocorre nas folhas.", "Redes neurais aprendem pesos.",
+                             "Fotossíntese e clorofila: a clorofila absorve luz."))
+    results = index.search("clorofila fotossintese", 3)
+    assert [idx for _, idx in results] == [2, 0]
+    assert results[0][0] > results[1][0]
+
+
+def test_bm25_folds_accents_and_skips_stopwords():
+    index = BM25Index(chunks("Ação e reação"))
+    assert index.search("acao", 1)
+    assert not index.search("e de", 1)
+
+
+def test_vector_index_ranks_by_cosine():
+    index = VectorIndex.build(["sobre planta", "sobre rede", "sobre estrela"], stub_embed)
+    assert index.search(stub_embed(["rede"])[0], 1)[0][1] == 1
+
+
+def test_embedding_store_builds_once_per_document():
+    store, calls = EmbeddingStore(max_docs=1), []
+
+    def counting(texts):
+        calls.append(texts)
+        return stub_embed(texts)
+
+    first = store.get_or_build("d1", ["planta"], counting, model="stub")
+    assert store.get_or_build("d1", ["planta"], counting, model="stub") is first
+    store.get_or_build("d2", ["rede"], counting, model="stub")
+    assert store.get("d1", model="stub") is None         # evicted (max_docs=1)
+    assert len(calls) == 2
+
+
+def test_embedding_store_releases_the_build_lock_on_failure():
+    store = EmbeddingStore()
+
+    def down(texts):
+        raise ConnectionError("ollama down")
+
+    with pytest.raises(ConnectionError):
+        store.get_or_build("d", ["x"], down, model="stub")
+    assert store._building == {}
+
+
+def test_select_context_fuses_lexical_and_semantic_rankings(embeddings, tmp_path):
+    corpus = DocumentCorpus(10**6, app.DocumentTextCache(str(tmp_path), 10**6, 10**6))
+    document(corpus, "c", "bio.txt", "A planta cresce com luz.", "Solo fértil.")
+    document(corpus, "c", "ia.txt", "A rede neural tem camadas.", "Gradiente descendente.")
+    # "redes" is no BM25 token of ia.txt (no stemming) but the same topic for the
+    # embedder; "solo" only matches bio.txt lexically: the fusion keeps both
+    picked = select_context(corpus, "c", "redes solo", top_k=2, embed_fn=stub_embed)
+    assert {(d.name, c["text"]) for d, c in picked} == {
+        ("bio.txt", "Solo fértil."), ("ia.txt", "A rede neural tem camadas.")}
+
+
+def test_select_context_respects_the_budget(embeddings, tmp_path):
+    corpus = DocumentCorpus(10**6, app.DocumentTextCache(str(tmp_path), 10**6, 10**6))
+    document(corpus, "c", "a.txt", "planta " * 50, "planta verde")
+    picked = select_context(corpus, "c", "planta", top_k=5, budget=60, embed_fn=stub_embed)
+    assert [c["text"] for _, c in picked] == ["planta verde"]
+
+
+def test_select_context_falls_back_to_opening_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "EMBED_MODEL", "")
+    corpus = DocumentCorpus(10**6, app.DocumentTextCache(str(tmp_path), 10**6, 10**6))
+    document(corpus, "c", "a.txt", "primeiro a", "segundo a", vectors=False)
+    document(corpus, "c", "b.txt", "primeiro b", vectors=False)
+    picked = select_context(corpus, "c", "resuma", top_k=3)
+    assert [c["text"] for _, c in picked] == ["primeiro a", "segundo a", "primeiro b"]
@@ -0,0 +1,86 @@
+from app import GenerationScheduler
+
+
+def grants(scheduler, jobs):
+    """Enqueue (model, anon_id) pairs; returns the tickets and the list they are granted into."""
+    order = []
+    tickets = [scheduler.enqueue(model, anon_id, order.append) for model, anon_id in jobs]
+    return tickets, order
+
+
+def test_grants_up_to_the_limit_then_queues():
+    scheduler = GenerationScheduler(default_limit=2)
+    tickets, order = grants(scheduler, [("m", "a")] * 3)
+    assert order == tickets[:2]
+    assert scheduler.snapshot() == {"m": {"running": 2, "waiting": 1}}
+    assert scheduler.position(tickets[2]) == 1
+
+
+def test_release_hands_the_slot_to_the_next_ticket():
+    scheduler = GenerationScheduler(default_limit=1)
+    tickets, order = grants(scheduler, [("m", "a"), ("m", "b")])
+    assert order == [tickets[0]]
+    scheduler.release(tickets[0])
+    assert order == tickets
+    scheduler.release(tickets[1])
+    assert scheduler.snapshot() == {"m": {"running": 0, "waiting": 0}}
+
+
+def test_sessions_are_served_round_robin():
+    scheduler = GenerationScheduler(default_limit=1)
+    running, _ = grants(scheduler, [("m", "x")])
+    tickets, order = grants(scheduler, [("m", "a"), ("m", "a"), ("m", "a"), ("m", "b")])
+    a1, a2, a3, b1 = tickets
+    assert [scheduler.position(t) for t in tickets] == [1, 3, 4, 2]
+    scheduler.release(running[0])
+    served = 0
+    while served < len(order):
+        scheduler.release(order[served])
+        served += 1
+    assert order == [a1, b1, a2, a3]
+
+
+def test_limits_are_per_model():
+    scheduler = GenerationScheduler(default_limit=1)
+    tickets, order = grants(scheduler, [("m1", "a"), ("m2", "a"), ("m1", "b")])
+    assert order == tickets[:2]
+    assert scheduler.position(tickets[2]) == 1
+
+
+def test_withdraw_leaves_the_line():
+    scheduler = GenerationScheduler(default_limit=1)
+    tickets, order = grants(scheduler, [("m", "a"), ("m", "b"), ("m", "c")])
+    assert scheduler.withdraw(tickets[1])
+    assert scheduler.position(tickets[1]) == 0
+    assert scheduler.position(tickets[2]) == 1
+    scheduler.release(tickets[0])
+    assert order == [tickets[0], tickets[2]]
+
+
+def test_withdraw_twice_is_a_no_op():
+    scheduler = GenerationScheduler(default_limit=1)
+    tickets, _ = grants(scheduler, [("m", "a"), ("m", "a")])
+    assert scheduler.withdraw(tickets[1])
+    assert not scheduler.withdraw(tickets[1])
+    assert scheduler.snapshot() == {"m": {"running": 1, "waiting": 0}}
+
+
+def test_withdraw_after_grant_refuses():
+    scheduler = GenerationScheduler(default_limit=1)
+    tickets, _ = grants(scheduler, [("m", "a")])
+    assert not scheduler.withdraw(tickets[0])
+    assert scheduler.snapshot() == {"m": {"running": 1, "waiting": 0}}
+
+
+def test_limit_overrides_match_by_model_key():
+    scheduler = GenerationScheduler(default_limit=4, limits={"llama3": 1, "qwen2:7b": 2})
+    assert scheduler.limit_for("llama3:latest") == 1
+    assert scheduler.limit_for("llama3") == 1
+    assert scheduler.limit_for("qwen2:7b") == 2
+    assert scheduler.limit_for("qwen2") == 4
+
+
+def test_limit_override_applies_to_the_name_the_ui_sends():
+    scheduler = GenerationScheduler(default_limit=4, limits={"llama3": 1})
+    tickets, order = grants(scheduler, [("llama3:latest", "a"), ("llama3:latest", "b")])
+    assert order == tickets[:1]
@@ -0,0 +1,82 @@
+import random
+
+import pytest
+
+import app
+from app import STOPPED_NOTE, StreamRenderer
+
+
+class Placeholder:
+    def __init__(self):
+        self.frames = []
+
+    def markdown(self, body):
+        self.frames.append(body)
+
+
+REPLY = "Veja:\n```python\nprint('a')\n```\nE `inline` e mais:\n````\nbloco\n````\nfim\n```sh\nls"
+
+
+def renderer(**kw):
+    # max_fps=0: every chunk is drawn, so each frame can be checked
+    return StreamRenderer(Placeholder(), max_fps=kw.pop("max_fps", 0), **kw)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_fence_tracking_matches_a_full_count_for_any_chunking(seed):
+    rng = random.Random(seed)
+    r = renderer()
+    pos = 0
+    while pos < len(REPLY):
+        step = rng.randint(1, 5)
+        r.feed(REPLY[pos:pos + step])
+        pos += step
+        assert r.in_code_block == (REPLY[:pos].count("```") % 2 == 1)
+
+
+def test_fence_split_across_chunks_is_counted_once():
+    r = renderer()
+    for chunk in ("texto `", "`", "`py\nx = 1\n", "``", "`\n"):
+        r.feed(chunk)
+    assert r._fences == 2
+    assert not r.in_code_block
+
+
+def test_cursor_frames_close_an_open_fence():
+    r = renderer()
+    r.feed("a\n```py\nx = 1")
+    assert r.placeholder.frames[-1] == "a\n```py\nx = 1\n```\n\n" + StreamRenderer.CURSOR
+    r.feed("\n```\nok")
+    assert r.placeholder.frames[-1] == "a\n```py\nx = 1\n```\nok" + StreamRenderer.CURSOR
+
+
+def test_finish_draws_the_text_without_cursor():
+    r = renderer()
+    r.feed("um ")
+    r.feed("dois")
+    assert r.finish() == "um dois"
+    assert r.placeholder.frames[-1] == "um dois"
+    assert r.stats() == {"frames": 3, "bytes": sum(len(f.encode()) for f in r.placeholder.frames), "chars": 7}
+
+
+def test_frames_are_throttled_until_enough_text_piles_up():
+    r = renderer(max_fps=1, flush_chars=10)
+    r.feed("abc")           # first chunk: the interval since start has passed
+    r.feed("def")
+    r.feed("ghijklmnop")    # 13 pending chars >= flush_chars
+    assert r.placeholder.frames == ["abc" + StreamRenderer.CURSOR, "abcdefghijklmnop" + StreamRenderer.CURSOR]
+
+
+def test_fence_closer():
+    assert StreamRenderer.fence_closer("sem código") == ""
+    assert StreamRenderer.fence_closer("```py\nx") == "\n```"
+    assert StreamRenderer.fence_closer("```py\nx\n```") == ""
+
+
+def test_stop_note_is_not_sent_back_to_the_model(monkeypatch):
+    monkeypatch.setattr(app, "model_context_length", lambda model: 4096)
+    stopped = "```py\nx = 1\n```" + STOPPED_NOTE
+    history = [{"role": "user", "content": "oi"}, {"role": "assistant", "content": stopped}]
+    messages, _, _ = app.build_api_messages("m", "sys", history, "e agora?")
+    assert messages[2] == {"role": "assistant", "content": "```py\nx = 1\n```"}
+    assert history[1]["content"] == stopped